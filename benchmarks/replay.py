@@ -0,0 +1,220 @@
+"""Replay a log of updates recorded by the bot against the dispatcher, and measure how it keeps up.
+
+The updates are routed by a real dispatcher to real workers, using the database and the config specified, while the
+answers of the bot are sent to a fake Bot API running in process. The latency of an update is the time between it being
+handed to the dispatcher and the first answer the bot sends to its chat.
+The replayed conversations write to the database: use a copy of the real one! An SQLite database has to be opened
+with check_same_thread=False, as it's used by many threads.
+
+Run it from the repository root, with record_updates set in the config to record the log:
+    python -m benchmarks.replay updates.log.gz --database "sqlite:///replay.sqlite?check_same_thread=False" --speed 10
+"""
+import argparse
+import collections
+import statistics
+import threading
+import time
+import types
+from typing import *
+
+import sqlalchemy.event
+import telegram
+
+import core
+import downloads
+import duckbot
+import fakeapi
+import imagestore
+import imaging
+import localization
+import nuconfig
+import recording
+
+
+class ReplaySource:
+    """A source of updates returning the recorded batches, spaced out as they were received and sped up by speed.
+    A speed of 0 returns them as fast as the dispatcher asks for them."""
+
+    # The log can span many runs of the bot, so the offset is ignored
+    uses_offset = False
+
+    def __init__(self, batches, bot, speed: float, max_gap: float):
+        self.bot = bot
+        self.speed: float = speed
+        # The time every batch is due, relative to the start of the replay; long pauses are shortened to max_gap
+        self.batches: Deque[Tuple[float, List[dict]]] = collections.deque()
+        due = 0.0
+        previous = batches[0][0] if batches else 0.0
+        for received, updates in batches:
+            due += min(received - previous, max_gap)
+            previous = received
+            self.batches.append((due, updates))
+        self.start: Optional[float] = None
+        # The time the updates still waiting for an answer were handed to the dispatcher, by chat
+        self.pending: Dict[int, List[float]] = collections.defaultdict(list)
+        # The chats of the callback queries, which are answered without specifying the chat
+        self.callback_chats: Dict[str, int] = {}
+        self.latencies: List[float] = []
+        self.last_answer: Optional[float] = None
+        self.delivered: int = 0
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+
+    def get_updates(self, offset: Optional[int] = None, timeout: Optional[float] = None) -> List[telegram.Update]:
+        if self.start is None:
+            self.start = time.monotonic()
+        if not self.batches:
+            self.finished.set()
+            time.sleep(timeout or 0)
+            return []
+        due, data = self.batches.popleft()
+        if self.speed:
+            delay = self.start + due / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        updates = [telegram.Update.de_json(update_data, self.bot.bot) for update_data in data]
+        now = time.monotonic()
+        with self.lock:
+            for update in updates:
+                if update.effective_chat is not None:
+                    self.pending[update.effective_chat.id].append(now)
+                if update.callback_query is not None and update.effective_chat is not None:
+                    self.callback_chats[update.callback_query.id] = update.effective_chat.id
+            self.delivered += len(updates)
+        return updates
+
+    def answered(self, params: Dict[str, Any]):
+        """Record a call of the bot to the API: if it's an answer to a chat, all its pending updates are answered."""
+        now = time.monotonic()
+        with self.lock:
+            if "chat_id" in params:
+                chat_id = fakeapi.FakeBotAPI.chat_key(params["chat_id"])
+            elif "callback_query_id" in params:
+                chat_id = self.callback_chats.pop(params["callback_query_id"], None)
+            else:
+                return
+            for delivered in self.pending.pop(chat_id, []):
+                self.latencies.append(now - delivered)
+                self.last_answer = now
+
+    def waiting(self) -> int:
+        with self.lock:
+            return sum(len(times) for times in self.pending.values())
+
+
+class Gauges:
+    """Sample the workers and the database connections in use while the replay is running."""
+
+    def __init__(self, dispatcher: core.Dispatcher, engine):
+        self.dispatcher = dispatcher
+        self.sessions: int = 0
+        self.max_sessions: int = 0
+        self.max_workers: int = 0
+        self.max_busy_workers: int = 0
+        self.lock = threading.Lock()
+        sqlalchemy.event.listen(engine, "checkout", self.__checkout)
+        sqlalchemy.event.listen(engine, "checkin", self.__checkin)
+        threading.Thread(target=self.__sample, name="Gauges", daemon=True).start()
+
+    def __checkout(self, *args):
+        with self.lock:
+            self.sessions += 1
+            self.max_sessions = max(self.max_sessions, self.sessions)
+
+    def __checkin(self, *args):
+        with self.lock:
+            self.sessions -= 1
+
+    def __sample(self):
+        while True:
+            workers = list(self.dispatcher.chat_workers.values())
+            self.max_workers = max(self.max_workers, sum(chat_worker.is_alive() for chat_worker in workers))
+            self.max_busy_workers = max(self.max_busy_workers,
+                                        sum(not chat_worker.is_idle() for chat_worker in workers))
+            time.sleep(0.01)
+
+
+def replay(cfg: nuconfig.NuConfig, batches, speed: float, max_gap: float, latency: float, drain_timeout: float):
+    """Replay the batches, and return the report of the measures."""
+    api = fakeapi.FakeBotAPI(latency=latency)
+    api.start()
+    cfg["Telegram"]["api_url"] = api.url
+    engine = core.create_engine(cfg)
+    imagestore.configure(cfg)
+    imaging.configure(cfg)
+    downloads.configure(cfg)
+    bot = duckbot.factory(cfg)()
+    default_loc = localization.Localization(language=cfg["Language"]["default_language"],
+                                            fallback=cfg["Language"]["default_language"])
+    source = ReplaySource(batches, bot, speed=speed, max_gap=max_gap)
+    # Count the answers of the bot to every chat
+    call = api.call
+
+    def answering_call(method, params):
+        source.answered(params)
+        return call(method, params)
+
+    api.call = answering_call
+    dispatcher = core.create_dispatcher(bot=bot, cfg=cfg, engine=engine, default_loc=default_loc, source=source)
+    gauges = Gauges(dispatcher, engine)
+    threading.Thread(target=dispatcher.run, name="Dispatcher", daemon=True).start()
+    source.finished.wait()
+    # Wait for the last updates to be answered
+    end = time.monotonic() + drain_timeout
+    while source.waiting() and time.monotonic() < end:
+        time.sleep(0.05)
+    # Measure until the last answer, not counting the time waited for the updates which got none
+    elapsed = (source.last_answer or time.monotonic()) - source.start
+    latencies = sorted(source.latencies) or [0.0]
+    return types.SimpleNamespace(
+        updates=source.delivered,
+        answered=len(source.latencies),
+        unanswered=source.waiting(),
+        elapsed=elapsed,
+        throughput=len(source.latencies) / elapsed,
+        mean=statistics.mean(latencies),
+        p50=latencies[int(len(latencies) * 0.50)],
+        p95=latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+        p99=latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)],
+        max=latencies[-1],
+        max_workers=gauges.max_workers,
+        max_busy_workers=gauges.max_busy_workers,
+        max_sessions=gauges.max_sessions,
+        calls=sum(api.calls.values()),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("log", help="the log of updates recorded by the bot")
+    parser.add_argument("--config", default="config/config.toml", help="the config of the bot")
+    parser.add_argument("--database", required=True, help="the database to use, overriding the one in the config")
+    parser.add_argument("--speed", type=float, default=1, help="speed of the replay; 0 replays as fast as possible")
+    parser.add_argument("--max-gap", type=float, default=60, help="maximum seconds between two batches")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the fake Bot API takes to answer")
+    parser.add_argument("--drain-timeout", type=float, default=10,
+                        help="maximum seconds to wait for the last updates to be answered")
+    args = parser.parse_args()
+
+    with open(args.config, encoding="utf8") as cfg_file:
+        cfg = nuconfig.NuConfig(cfg_file)
+    cfg["Database"]["engine"] = args.database
+    cfg["Telegram"]["long_polling_timeout"] = 1
+    cfg["Telegram"]["record_updates"] = ""
+    core.setup_logging(cfg)
+
+    batches = recording.load(args.log)
+    report = replay(cfg, batches, speed=args.speed, max_gap=args.max_gap, latency=args.latency,
+                    drain_timeout=args.drain_timeout)
+    print(f"updates:          {report.updates} in {report.elapsed:.1f} secs"
+          f" ({report.answered} answered, {report.unanswered} unanswered)")
+    print(f"throughput:       {report.throughput:.1f} answered updates/s")
+    print(f"latency:          mean {report.mean * 1000:.0f} ms, p50 {report.p50 * 1000:.0f} ms,"
+          f" p95 {report.p95 * 1000:.0f} ms, p99 {report.p99 * 1000:.0f} ms, max {report.max * 1000:.0f} ms")
+    print(f"workers:          {report.max_workers} alive at most, {report.max_busy_workers} busy at most")
+    print(f"db connections:   {report.max_sessions} in use at most")
+    print(f"bot api calls:    {report.calls}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Measure how the throughput of the sharded core scales with the number of shards.
+
+The updates are routed by a real ShardingDispatcher, and every shard parses them and performs the CPU-bound work of a
+conversation step: an ORM query on the catalog and the formatting of the localized strings.
+No bot token or network access is needed, as nothing is sent to Telegram.
+
+Run it from the repository root:
+    python -m benchmarks.shards --updates 20000 --max-shards 4
+"""
+import argparse
+import multiprocessing
+import os
+import time
+import types
+
+import sqlalchemy.orm
+import telegram
+
+import core
+import database as db
+import localization
+
+# A syntactically valid token, never sent anywhere
+TOKEN = "123456:benchmark"
+
+
+def bench_shard(cfg: dict, index: int, updates_queue: multiprocessing.Queue):
+    """The shard process of the benchmark: perform the work of a conversation step for every received update."""
+    results = cfg["Benchmark"]["results"]
+    # Create a catalog in an in-memory database
+    engine = core.create_engine({"Database": {"engine": "sqlite://"}})
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    for number in range(cfg["Benchmark"]["products"]):
+        session.add(db.Product(name=f"Product {number}", description="A product", price=1000, deleted=False))
+    session.commit()
+    loc = localization.Localization(language="en", fallback="en")
+    source = core.ShardSource(types.SimpleNamespace(bot=telegram.Bot(TOKEN)), updates_queue)
+    results.put(("ready", index))
+    processed = 0
+    while True:
+        for update in source.get_updates(timeout=1):
+            # A None update is the signal that the benchmark has ended
+            if update is None:
+                results.put(("done", index, processed))
+                return
+            for product in session.query(db.Product).filter_by(deleted=False).all():
+                loc.get("product_format_string",
+                        name=product.name,
+                        description=update.message.text,
+                        price=str(product.price),
+                        cart="")
+            processed += 1
+
+
+def make_updates(count: int, chats: int, bot: telegram.Bot):
+    """Create count text message updates, spread over the specified number of private chats."""
+    updates = []
+    for update_id in range(count):
+        chat_id = 1000 + update_id % chats
+        updates.append(telegram.Update.de_json({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Customer"},
+                "text": f"Message {update_id}",
+            }
+        }, bot))
+    return updates
+
+
+def measure(shards: int, updates, products: int) -> float:
+    """Route the updates to the specified number of shards, and return how many updates per second were processed."""
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    cfg = {
+        "Benchmark": {"results": results, "products": products},
+    }
+    dispatcher = core.ShardingDispatcher(bot=None, cfg=cfg, engine=None, default_loc=None,
+                                         shards=shards, shard_main=bench_shard)
+    # Wait for all the shards to be ready, so that their startup isn't measured
+    for _ in range(shards):
+        results.get()
+    start = time.perf_counter()
+    for update in updates:
+        dispatcher.route(update)
+    for shard_queue in dispatcher.shard_queues:
+        shard_queue.put(None)
+    processed = sum(results.get()[2] for _ in range(shards))
+    elapsed = time.perf_counter() - start
+    for process in dispatcher.shard_processes:
+        process.join()
+    assert processed == len(updates)
+    return processed / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=20000, help="number of updates to route")
+    parser.add_argument("--chats", type=int, default=1000, help="number of chats the updates are spread over")
+    parser.add_argument("--products", type=int, default=30, help="number of products in the catalog")
+    parser.add_argument("--max-shards", type=int, default=os.cpu_count(), help="highest number of shards to measure")
+    args = parser.parse_args()
+
+    updates = make_updates(args.updates, args.chats, telegram.Bot(TOKEN))
+    print(f"{'shards':>6} | {'updates/s':>10} | {'speedup':>7}")
+    baseline = None
+    for shards in range(1, args.max_shards + 1):
+        throughput = measure(shards, updates, args.products)
+        baseline = baseline or throughput
+        print(f"{shards:>6} | {throughput:>10.0f} | {throughput / baseline:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
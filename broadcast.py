@@ -0,0 +1,168 @@
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import *
+
+import telegram
+
+import nuconfig
+
+log = logging.getLogger(__name__)
+
+# A call of a bot method made for every recipient of a broadcast: the name of the method and its arguments,
+# except for chat_id
+BroadcastCall = Tuple[str, Dict[str, Any]]
+
+
+class Delivery:
+    """The delivery of a broadcast to one of its recipients."""
+
+    def __init__(self, recipient):
+        self.recipient = recipient
+        # The number of calls already made; a retry resumes from the first one which failed
+        self.sent: int = 0
+        self.attempts: int = 0
+        # The error of the last attempt, if it failed
+        self.error: Optional[Exception] = None
+        # Whether the delivery failed in a way retrying can't fix, like the bot being blocked
+        self.permanent: bool = False
+
+    @property
+    def delivered(self) -> bool:
+        return self.error is None and not self.permanent
+
+    def __repr__(self):
+        return f"<Delivery to {self.recipient}: {'delivered' if self.delivered else repr(self.error)}>"
+
+
+class BroadcastReport:
+    """The results of a broadcast, available when all its deliveries have succeeded or run out of retries."""
+
+    def __init__(self, deliveries: List[Delivery], elapsed: float):
+        self.deliveries: List[Delivery] = deliveries
+        self.elapsed: float = elapsed
+
+    @property
+    def delivered(self) -> List[Delivery]:
+        return [delivery for delivery in self.deliveries if delivery.delivered]
+
+    @property
+    def failed(self) -> List[Delivery]:
+        return [delivery for delivery in self.deliveries if not delivery.delivered]
+
+    def __str__(self):
+        report = f"Broadcast delivered to {len(self.delivered)}/{len(self.deliveries)} chats in {self.elapsed:.1f} secs"
+        for delivery in self.failed:
+            report += f"\nFailed delivery to {delivery.recipient} after {delivery.attempts} attempts: {delivery.error!r}"
+        return report
+
+
+class Broadcast:
+    """A broadcast whose deliveries are in progress."""
+
+    def __init__(self, bot, deliveries: List[Delivery], calls: List[BroadcastCall]):
+        self.bot = bot
+        self.deliveries: List[Delivery] = deliveries
+        self.calls: List[BroadcastCall] = calls
+        self.future = concurrent.futures.Future()
+        self.start: float = time.monotonic()
+        # The number of deliveries which haven't succeeded or run out of retries yet
+        self.remaining: int = len(deliveries)
+        self.lock = threading.Lock()
+
+
+class Broadcaster:
+    """Deliver the same messages to many chats concurrently, in the background.
+    The bot methods apply the rate limits, but are called without retries: the deliveries which fail are scheduled
+    again by a single coordinator thread, after all the others have been made, instead of delaying them."""
+
+    def __init__(self, cfg: nuconfig.NuConfig):
+        settings = cfg["Telegram"]["Broadcast"]
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings["threads"],
+                                                              thread_name_prefix="Broadcast")
+        self.retries: int = settings["retries"]
+        self.retry_delay: float = settings["retry_delay"]
+        # The deliveries waiting to be made, as a heap of (due time, sequence number, broadcast, delivery)
+        self.schedule: List[Tuple[float, int, Broadcast, Delivery]] = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        # The thread handing the deliveries to the executor when they are due, started by the first broadcast
+        self.coordinator: Optional[threading.Thread] = None
+
+    def broadcast(self, bot, recipients: Iterable, calls: List[BroadcastCall]) -> concurrent.futures.Future:
+        """Make the calls in order for every recipient, and return a future of the BroadcastReport."""
+        # Deliver only once to every recipient, even if it's listed more than once
+        job = Broadcast(bot, [Delivery(recipient) for recipient in dict.fromkeys(recipients)], calls)
+        if not job.deliveries:
+            self.__report(job)
+        for delivery in job.deliveries:
+            self.__schedule(job, delivery, 0)
+        return job.future
+
+    def __schedule(self, job: Broadcast, delivery: Delivery, delay: float):
+        """Make a delivery in delay seconds."""
+        with self.condition:
+            heapq.heappush(self.schedule, (time.monotonic() + delay, next(self.sequence), job, delivery))
+            if self.coordinator is None:
+                self.coordinator = threading.Thread(target=self.__coordinate, name="Broadcast coordinator",
+                                                    daemon=True)
+                self.coordinator.start()
+            self.condition.notify()
+
+    def __coordinate(self):
+        """Hand the deliveries to the executor when they are due, forever."""
+        while True:
+            with self.condition:
+                while not self.schedule or self.schedule[0][0] > time.monotonic():
+                    self.condition.wait(self.schedule[0][0] - time.monotonic() if self.schedule else None)
+                _, _, job, delivery = heapq.heappop(self.schedule)
+            self.executor.submit(self.__deliver, job, delivery)
+
+    def __deliver(self, job: Broadcast, delivery: Delivery):
+        """Make the calls of a delivery which haven't been made yet, and schedule it again if they failed."""
+        delivery.attempts += 1
+        delivery.error = None
+        retry_after = None
+        try:
+            while delivery.sent < len(job.calls):
+                name, kwargs = job.calls[delivery.sent]
+                result = getattr(job.bot, name)(chat_id=delivery.recipient, max_retries=0, **kwargs)
+                # The bot methods return None if the bot was blocked or removed from the chat
+                if result is None:
+                    delivery.permanent = True
+                    delivery.error = telegram.error.Unauthorized("Bot can't send messages to the chat")
+                    break
+                delivery.sent += 1
+        # Retrying a bad request would fail again
+        except telegram.error.BadRequest as error:
+            delivery.permanent = True
+            delivery.error = error
+        # The chat can't receive messages until the flood limit expires
+        except telegram.error.RetryAfter as error:
+            delivery.error = error
+            retry_after = error.retry_after
+        except Exception as error:
+            delivery.error = error
+        if delivery.error is not None and not delivery.permanent and delivery.attempts <= self.retries:
+            delay = max(self.retry_delay * 2 ** (delivery.attempts - 1), retry_after or 0)
+            log.warning(f"Retrying the broadcast delivery to {delivery.recipient} in {delay} secs...")
+            self.__schedule(job, delivery, delay)
+            return
+        with job.lock:
+            job.remaining -= 1
+            done = job.remaining == 0
+        if done:
+            self.__report(job)
+
+    @staticmethod
+    def __report(job: Broadcast):
+        """Complete the future of a broadcast with its report."""
+        report = BroadcastReport(job.deliveries, elapsed=time.monotonic() - job.start)
+        if report.failed:
+            log.error(str(report))
+        else:
+            log.debug(str(report))
+        job.future.set_result(report)
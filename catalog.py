@@ -0,0 +1,211 @@
+import logging
+import threading
+import time
+import types
+from typing import *
+
+import sqlalchemy.orm
+import telegram
+
+import database as db
+import utils
+
+if TYPE_CHECKING:
+    import worker
+
+log = logging.getLogger(__name__)
+
+
+class CatalogCategory(NamedTuple):
+    """A category of products visible to the customers."""
+    id: int
+    name: str
+    parent_id: Optional[int]
+
+
+class CatalogSize(NamedTuple):
+    """A size of a product."""
+    id: int
+    product_id: int
+    name: str
+    price: int
+
+
+class CatalogProduct(NamedTuple):
+    """A product, with the data needed to show it to the customers and its sizes."""
+    id: int
+    name: str
+    description: str
+    price: Optional[int]
+    category_id: Optional[int]
+    has_image: bool
+    image_file_id: Optional[str]
+    sizes: Tuple[CatalogSize, ...]
+
+    def text(self, w: "worker.Worker", *, style: str = "full", cart_qty: int = None, size_id: int = None) -> str:
+        """Return the product details formatted with Telegram HTML, like Product.text does."""
+        if size_id is not None:
+            size = next(size for size in self.sizes if size.id == size_id)
+            size_name = " " + str(size.name)
+            price = str(w.Price(float(size.price)))
+        else:
+            size_name = ""
+            price = "" if self.sizes else str(w.Price(self.price))
+        if style == "short":
+            return f"{cart_qty}x {utils.telegram_html_escape(self.name + size_name)} - {price * cart_qty}"
+        elif style == "full":
+            cart = w.loc.get("in_cart_format_string", quantity=cart_qty) if cart_qty is not None else ""
+            return w.loc.get("product_format_string",
+                             name=utils.telegram_html_escape(self.name) + size_name,
+                             description=utils.telegram_html_escape(self.description),
+                             price=price,
+                             cart=cart)
+        else:
+            raise ValueError("style is not an accepted value")
+
+    def send_as_message(self, w: "worker.Worker", chat_id: int) -> telegram.Message:
+        """Send a message containing the product data.
+        The database is used only the first time the image is sent, to upload it and remember its file_id."""
+        if not self.has_image:
+            return w.bot.send_message(chat_id, self.text(w))
+        if self.image_file_id is not None:
+            try:
+                return w.bot.send_photo(chat_id, photo=self.image_file_id, caption=self.text(w))
+            # Let the database product upload the image again
+            except telegram.error.BadRequest:
+                pass
+        session = w.sessionmaker()
+        try:
+            product = session.query(db.Product).filter_by(id=self.id).one()
+            message = product.send_as_message(w, chat_id, text=self.text(w))
+            image_file_id = product.image_file_id
+        finally:
+            session.close()
+        # Remember the new file_id of the image, without loading the whole catalog again
+        if image_file_id != self.image_file_id:
+            set_image_file_id(self.id, image_file_id)
+        return message
+
+
+class Catalog:
+    """An immutable snapshot of the categories, products and sizes which aren't deleted, indexed by id and by name.
+    The mappings are read-only views: a snapshot is never modified, a new one is loaded instead."""
+
+    def __init__(self, categories: Iterable[CatalogCategory], products: Iterable[CatalogProduct]):
+        # The time the snapshot was loaded at
+        self.loaded: float = time.monotonic()
+        categories = list(categories)
+        products = list(products)
+        self.categories: Mapping[int, CatalogCategory] = types.MappingProxyType(
+            {category.id: category for category in categories})
+        self.categories_by_name: Mapping[str, CatalogCategory] = types.MappingProxyType(
+            {category.name: category for category in categories})
+        self.products: Mapping[int, CatalogProduct] = types.MappingProxyType(
+            {product.id: product for product in products})
+        self.products_by_name: Mapping[str, CatalogProduct] = types.MappingProxyType(
+            {product.name: product for product in products})
+        self.sizes: Mapping[int, CatalogSize] = types.MappingProxyType(
+            {size.id: size for product in products for size in product.sizes})
+        # The subcategories and the products of every category, in the order of their ids; None is the top level
+        subcategories: Dict[Optional[int], List[CatalogCategory]] = {}
+        for category in categories:
+            subcategories.setdefault(category.parent_id, []).append(category)
+        self.__subcategories: Mapping[Optional[int], Tuple[CatalogCategory, ...]] = types.MappingProxyType(
+            {parent_id: tuple(children) for parent_id, children in subcategories.items()})
+        category_products: Dict[Optional[int], List[CatalogProduct]] = {}
+        for product in products:
+            category_products.setdefault(product.category_id, []).append(product)
+        self.__category_products: Mapping[Optional[int], Tuple[CatalogProduct, ...]] = types.MappingProxyType(
+            {category_id: tuple(children) for category_id, children in category_products.items()})
+
+    def subcategories(self, category_id: Optional[int]) -> Tuple[CatalogCategory, ...]:
+        """Get the subcategories of a category, or the top level categories if category_id is None."""
+        return self.__subcategories.get(category_id, ())
+
+    def category_products(self, category_id: Optional[int]) -> Tuple[CatalogProduct, ...]:
+        """Get the products of a category, or the products without a category if category_id is None."""
+        return self.__category_products.get(category_id, ())
+
+    def with_product(self, product: CatalogProduct) -> "Catalog":
+        """Get a copy of the snapshot with a product replaced, as old as the snapshot itself."""
+        products = dict(self.products)
+        products[product.id] = product
+        catalog = Catalog(categories=self.categories.values(), products=products.values())
+        catalog.loaded = self.loaded
+        return catalog
+
+    @classmethod
+    def load(cls, session) -> "Catalog":
+        """Load a snapshot of the catalog from the database."""
+        categories = session.query(db.Category).filter_by(is_active=True, deleted=False).order_by(db.Category.id)
+        products = session.query(db.Product).filter_by(deleted=False).order_by(db.Product.id)
+        sizes: Dict[int, List[CatalogSize]] = {}
+        for size in session.query(db.Size).filter_by(deleted=False).order_by(db.Size.id):
+            sizes.setdefault(size.product_id, []).append(CatalogSize(id=size.id,
+                                                                     product_id=size.product_id,
+                                                                     name=size.name,
+                                                                     price=size.price))
+        return cls(categories=[CatalogCategory(id=category.id,
+                                               name=category.name,
+                                               parent_id=category.parent_id)
+                               for category in categories],
+                   products=[CatalogProduct(id=product.id,
+                                            name=product.name,
+                                            description=product.description,
+                                            price=product.price,
+                                            category_id=product.category_id,
+                                            has_image=product.has_image,
+                                            image_file_id=product.image_file_id,
+                                            sizes=tuple(sizes.get(product.id, ())))
+                             for product in products])
+
+    def __repr__(self):
+        return f"<Catalog of {len(self.categories)} categories and {len(self.products)} products>"
+
+
+# The current snapshot of the catalog, or None if it has to be loaded again
+_catalog: Optional[Catalog] = None
+# Lock serialising the loads and the invalidations; the reads don't take it
+_lock = threading.Lock()
+
+
+def get(sessionmaker: sqlalchemy.orm.sessionmaker, max_age: float) -> Catalog:
+    """Get the snapshot of the catalog, loading it if it was invalidated or is older than max_age seconds.
+    The snapshot is shared by all the threads of the process; the processes of the other shards are told of the
+    changes only by max_age."""
+    catalog = _catalog
+    if catalog is not None and time.monotonic() - catalog.loaded < max_age:
+        return catalog
+    return _load(sessionmaker, max_age)
+
+
+def _load(sessionmaker: sqlalchemy.orm.sessionmaker, max_age: float) -> Catalog:
+    global _catalog
+    with _lock:
+        # Another thread may have loaded it while this one was waiting
+        if _catalog is not None and time.monotonic() - _catalog.loaded < max_age:
+            return _catalog
+        session = sessionmaker()
+        try:
+            _catalog = Catalog.load(session)
+        finally:
+            session.close()
+        log.debug(f"Loaded {_catalog}")
+        return _catalog
+
+
+def invalidate():
+    """Drop the snapshot of the catalog, after the categories, products or sizes have been changed."""
+    global _catalog
+    # Wait for a load in progress, which may have read the data from before the change
+    with _lock:
+        _catalog = None
+
+
+def set_image_file_id(product_id: int, file_id: str):
+    """Set the file_id of the image of a product in the snapshot of the catalog, without loading it again."""
+    global _catalog
+    with _lock:
+        if _catalog is None or product_id not in _catalog.products:
+            return
+        _catalog = _catalog.with_product(_catalog.products[product_id]._replace(image_file_id=file_id))
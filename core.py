@@ -1,7 +1,16 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import json
 import logging
+import multiprocessing
 import os
+import queue as queuem
 import sys
 import threading
+import time
+from typing import *
 
 import sqlalchemy
 import sqlalchemy.ext.declarative as sed
@@ -9,9 +18,14 @@ import sqlalchemy.orm
 import telegram
 
 import database
+import downloads
 import duckbot
+import imagestore
+import imaging
 import localization
 import nuconfig
+import recording
+import webhook
 import worker
 
 try:
@@ -20,13 +34,620 @@ except ImportError:
     coloredlogs = None
 
 
+log = logging.getLogger("core")
+
+
+class SeenUpdates:
+    """The ids of the most recent updates received from a source which ignores the offset, like the webhook.
+    The updates it pushes can arrive out of order and more than once, so they are deduplicated by the ids actually
+    seen instead of by the highest one."""
+
+    def __init__(self, size: int = 10000):
+        self.size: int = size
+        # The ids in the order they were seen, to forget the oldest ones
+        self.order: Deque[int] = collections.deque()
+        self.ids: Set[int] = set()
+
+    def add(self, update_id: int) -> bool:
+        """Remember an update id, and return False if it had already been seen."""
+        if update_id in self.ids:
+            return False
+        self.ids.add(update_id)
+        self.order.append(update_id)
+        if len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+        return True
+
+
+class Dispatcher:
+    """Route the updates received from Telegram to the Worker of their chat."""
+
+    def __init__(self, bot, cfg: nuconfig.NuConfig, engine, default_loc: localization.Localization, source=None):
+        self.bot = bot
+        # The pool of threads running the conversations of all the workers
+        self.pool = worker.ConversationPool(size=cfg["Telegram"]["conversation_threads"])
+        # The object the updates are fetched from: anything with a get_updates method, by default the bot itself
+        self.source = source if source is not None else bot
+        # The updates of the sources which ignore the offset are deduplicated by their ids
+        self.seen_updates: Optional[SeenUpdates] = None if getattr(self.source, "uses_offset", True) \
+            else SeenUpdates()
+        self.cfg = cfg
+        self.engine = engine
+        self.default_loc = default_loc
+        # Create a dictionary linking the chat ids to the Worker objects
+        # {"1234": <Worker>}
+        self.chat_workers = {}
+        # The chats whose conversation can be resumed from a checkpoint
+        self.resumable_chats: Set[int] = self.__load_resumable_chats()
+        # The workers replaced by a /start which are still ending their conversation
+        self.draining_workers = []
+        # The offset of the first update which hasn't been routed yet, and the condition notified when it changes
+        self.routed_offset: Optional[int] = None
+        self.routed_condition = threading.Condition()
+        # The time the ended workers were last removed from chat_workers
+        self.last_reap = time.monotonic()
+        # The updates dropped by the queues of the reaped workers
+        self.dropped_updates = 0
+        self.coalesced_updates = 0
+
+    def answer(self, func, *args, **kwargs):
+        """Call a bot method to answer an update directly from the routing code.
+        Override this to perform the call somewhere else instead of blocking the routing."""
+        try:
+            return func(*args, **kwargs)
+        # The call has run out of retries, but the routing must go on
+        except telegram.error.TelegramError as error:
+            log.error(f"Could not answer an update: {error!r}")
+
+    def run(self):
+        """Fetch the updates from the source and route them, one batch at a time.
+        The next batch is fetched by a separate thread while the current one is being routed."""
+        # The batches fetched and not routed yet; at most one batch is fetched in advance
+        batches = queuem.Queue(maxsize=1)
+        # Start fetching the updates
+        fetcher = threading.Thread(target=self.__fetch_updates, args=(batches,), name="Fetcher", daemon=True)
+        fetcher.start()
+        while True:
+            # Wait for the next batch; it's empty if the long polling request timed out
+            updates = batches.get()
+            # Don't hand the updates to workers which could only stall on an unreachable Telegram
+            self.wait_for_telegram()
+            # Parse all the updates
+            for update in updates:
+                self.route(update)
+            # If there were any updates...
+            if len(updates):
+                # Mark them as read by increasing the update_offset
+                with self.routed_condition:
+                    self.routed_offset = updates[-1].update_id + 1
+                    self.routed_condition.notify_all()
+            # Periodically free the workers whose conversation has ended
+            self.reap_workers_if_due()
+
+    def wait_for_telegram(self):
+        """Block while the circuit breaker of the bot is open, probing Telegram until it's reachable again."""
+        circuit_breaker = getattr(self.bot, "circuit_breaker", None)
+        if circuit_breaker is None or circuit_breaker.is_closed():
+            return
+        log.warning("Telegram is unreachable, waiting for it before routing the updates...")
+        while not circuit_breaker.wait_closed(timeout=circuit_breaker.reset_timeout):
+            # Probe Telegram, in case no other thread is calling it
+            try:
+                self.bot.get_me()
+            except telegram.error.TelegramError:
+                pass
+        log.info("Telegram is reachable again, resuming the routing")
+
+    def skip_seen_updates(self, updates: List[telegram.Update]) -> List[telegram.Update]:
+        """Remove the updates already received from a source which ignores the offset."""
+        new_updates = [update for update in updates if self.seen_updates.add(update.update_id)]
+        if len(new_updates) != len(updates):
+            log.debug(f"Skipped {len(updates) - len(new_updates)} updates received more than once")
+        return new_updates
+
+    def __fetch_updates(self, batches: queuem.Queue):
+        """Keep fetching batches of updates and put them in the batches queue, in order.
+        The offset sent to Telegram is only moved past a batch after it has been routed: the updates Telegram sends
+        again in the meantime are skipped. The sources which ignore the offset are deduplicated by update id."""
+        # The id the next fetched update should have; if None, any update is accepted
+        next_update = None
+        while True:
+            # Get a new batch of 100 updates and mark the last 100 routed as read
+            update_timeout = self.cfg["Telegram"]["long_polling_timeout"]
+            log.debug(f"Getting updates from Telegram with a timeout of {update_timeout} seconds")
+            updates = self.get_updates(offset=self.routed_offset, timeout=update_timeout)
+            if self.seen_updates is not None:
+                new_updates = self.skip_seen_updates(updates)
+                if len(new_updates):
+                    batches.put(new_updates)
+                continue
+            # Skip the updates which have already been fetched but haven't been routed yet
+            new_updates = [update for update in updates if next_update is None or update.update_id >= next_update]
+            # If only already fetched updates were received, wait for them to be routed before asking again
+            if len(updates) and not len(new_updates):
+                log.debug(f"Skipped {len(updates)} updates fetched again before being routed")
+                with self.routed_condition:
+                    self.routed_condition.wait_for(lambda: self.routed_offset == next_update)
+                continue
+            if len(new_updates):
+                next_update = new_updates[-1].update_id + 1
+            # Hand the batch over to the router, waiting if it is still routing the previous one
+            batches.put(new_updates)
+
+    def get_updates(self, offset: Optional[int], timeout: float) -> List[telegram.Update]:
+        """Get a batch of updates from the source.
+        If the source fails, the error is logged and an empty batch is returned after error_pause seconds, so that
+        the fetching never stops while the router waits for it."""
+        try:
+            return self.source.get_updates(offset=offset, timeout=timeout)
+        except Exception:
+            log.exception(f"Could not get the updates, retrying in {self.cfg['Telegram']['error_pause']} secs")
+            time.sleep(self.cfg["Telegram"]["error_pause"])
+            return []
+
+    def reap_workers_if_due(self):
+        """Reap the workers if reaper_interval seconds have passed since they were last reaped."""
+        if time.monotonic() - self.last_reap >= self.cfg["Telegram"]["reaper_interval"]:
+            self.reap_workers()
+
+    def reap_workers(self) -> Dict[str, int]:
+        """Remove the workers whose conversation has ended from chat_workers, allowing them to be garbage collected,
+        and report how many workers are live, idle and dead."""
+        self.last_reap = time.monotonic()
+        dead_chats = [chat_id for chat_id, chat_worker in self.chat_workers.items() if not chat_worker.is_alive()]
+        for chat_id in dead_chats:
+            self.__count_dropped_updates(self.chat_workers.pop(chat_id))
+        for chat_worker in self.draining_workers:
+            if not chat_worker.is_alive():
+                self.__count_dropped_updates(chat_worker)
+        self.draining_workers = [chat_worker for chat_worker in self.draining_workers if chat_worker.is_alive()]
+        live_workers = [*self.chat_workers.values(), *self.draining_workers]
+        stats = {
+            "live": len(self.chat_workers),
+            "idle": sum(1 for chat_worker in self.chat_workers.values() if chat_worker.is_idle()),
+            "draining": len(self.draining_workers),
+            "dead": len(dead_chats),
+            "dropped": self.dropped_updates + sum(chat_worker.queue.dropped for chat_worker in live_workers),
+            "coalesced": self.coalesced_updates + sum(chat_worker.queue.coalesced for chat_worker in live_workers),
+        }
+        log.info(f"Workers: {stats['live']} live, {stats['idle']} idle, {stats['draining']} draining,"
+                 f" {stats['dead']} dead reaped; updates: {stats['dropped']} dropped, {stats['coalesced']} coalesced")
+        return stats
+
+    def __count_dropped_updates(self, chat_worker: worker.Worker):
+        """Add the updates dropped by a reaped worker to the totals."""
+        self.dropped_updates += chat_worker.queue.dropped
+        self.coalesced_updates += chat_worker.queue.coalesced
+
+    def route(self, update: telegram.Update):
+        """Forward a single update to the worker of its chat, or answer it directly if it cannot be forwarded."""
+        # If the update is a message...
+        if update.message is not None:
+            # Ensure the message has been sent in a private chat
+            if update.message.chat.type != "private":
+                # if update.message.chat.id != "123":
+                log.debug(f"Received a message from a non-private chat: {update.message.chat.id}")
+                # Notify the chat
+                self.answer(self.bot.send_message, update.message.chat.id,
+                            self.default_loc.get("error_nonprivate_chat"))
+                # Skip the update
+                return
+            # If the message is a start command...
+            if isinstance(update.message.text, str) and update.message.text.startswith("/start"):
+                log.info(f"Received /start from: {update.message.chat.id}")
+                # Check if a worker already exists for that chat
+                old_worker = self.chat_workers.get(update.message.chat.id)
+                # If it exists, gracefully stop the worker without waiting for it: it will drain its queue in the
+                # pool, while the updates received from now on are queued for the new worker, which starts only
+                # after the old one has ended
+                if old_worker:
+                    log.debug(f"Received request to stop {old_worker.name}")
+                    old_worker.stop("request")
+                    self.draining_workers.append(old_worker)
+                # Initialize a new worker for the chat
+                new_worker = worker.Worker(bot=self.bot,
+                                           chat=update.message.chat,
+                                           telegram_user=update.message.from_user,
+                                           cfg=self.cfg,
+                                           engine=self.engine,
+                                           pool=self.pool)
+                # Start the worker
+                log.debug(f"Starting {new_worker.name}")
+                new_worker.start(after=old_worker)
+                # Store the worker in the dictionary
+                self.chat_workers[update.message.chat.id] = new_worker
+                # Skip the update
+                return
+            # Otherwise, forward the update to the corresponding worker
+            receiving_worker = self.chat_workers.get(update.message.chat.id)
+            # Ensure a worker exists for the chat and is alive
+            if receiving_worker is None:
+                # If the conversation was interrupted by a restart, resume it and let it process the update
+                if self.__resume_conversation(update.message.chat.id, update):
+                    return
+                log.debug(f"Received a message in a chat without worker: {update.message.chat.id}")
+                # Suggest that the user restarts the chat with /start
+                self.answer(self.bot.send_message, update.message.chat.id,
+                            self.default_loc.get("error_no_worker_for_chat"),
+                            reply_markup=telegram.ReplyKeyboardRemove())
+                # Skip the update
+                return
+            # If the worker is not ready...
+            if not receiving_worker.is_ready():
+                log.debug(f"Received a message in a chat where the worker wasn't ready yet: {update.message.chat.id}")
+                # Suggest that the user restarts the chat with /start
+                self.answer(self.bot.send_message, update.message.chat.id,
+                            self.default_loc.get("error_worker_not_ready"),
+                            reply_markup=telegram.ReplyKeyboardRemove())
+                # Skip the update
+                return
+            # If the message contains the "Cancel" string defined in the strings file...
+            if update.message.text == receiving_worker.loc.get("menu_cancel"):
+                log.debug(f"Forwarding CancelSignal to {receiving_worker}")
+                # Send a CancelSignal to the worker instead of the update
+                receiving_worker.put(worker.CancelSignal())
+            else:
+                log.debug(f"Forwarding message to {receiving_worker}")
+                # Forward the update to the worker
+                receiving_worker.put(update)
+        # If the update is a inline keyboard press...
+        if isinstance(update.callback_query, telegram.CallbackQuery):
+            # Forward the update to the corresponding worker
+            receiving_worker = self.chat_workers.get(update.callback_query.from_user.id)
+            # Ensure a worker exists for the chat
+            if receiving_worker is None:
+                # If the conversation was interrupted by a restart, resume it and let it process the update
+                if self.__resume_conversation(update.callback_query.from_user.id, update):
+                    return
+                log.debug(
+                    f"Received a callback query in a chat without worker: {update.callback_query.from_user.id}")
+                # Suggest that the user restarts the chat with /start
+                self.answer(self.bot.send_message, update.callback_query.from_user.id,
+                            self.default_loc.get("error_no_worker_for_chat"))
+                # Skip the update
+                return
+            # Check if the pressed inline key is a cancel button
+            if update.callback_query.data == "cmd_cancel":
+                log.debug(f"Forwarding CancelSignal to {receiving_worker}")
+                # Forward a CancelSignal to the worker
+                receiving_worker.put(worker.CancelSignal())
+                # Notify the Telegram client that the inline keyboard press has been received
+                self.answer(self.bot.answer_callback_query, update.callback_query.id)
+            else:
+                log.debug(f"Forwarding callback query to {receiving_worker}")
+                # Forward the update to the worker
+                receiving_worker.put(update)
+        # If the update is a precheckoutquery, ensure it hasn't expired before forwarding it
+        if isinstance(update.pre_checkout_query, telegram.PreCheckoutQuery):
+            # Forward the update to the corresponding worker
+            receiving_worker = self.chat_workers.get(update.pre_checkout_query.from_user.id)
+            # Check if it's the active invoice for this chat
+            if receiving_worker is None or \
+                    update.pre_checkout_query.invoice_payload != receiving_worker.invoice_payload:
+                # Notify the user that the invoice has expired
+                log.debug(f"Received a pre-checkout query for an expired invoice in:"
+                          f" {update.pre_checkout_query.from_user.id}")
+                self.answer(self.__reject_pre_checkout_query, update.pre_checkout_query)
+                # Go to the next update
+                return
+            log.debug(f"Forwarding pre-checkout query to {receiving_worker}")
+            # Forward the update to the worker
+            receiving_worker.put(update)
+
+    def __load_resumable_chats(self) -> Set[int]:
+        """Get the ids of the chats whose conversation was checkpointed before the bot was restarted."""
+        if self.engine is None or not self.cfg["Telegram"]["conversation_checkpoints"]:
+            return set()
+        session = sqlalchemy.orm.sessionmaker(bind=self.engine)()
+        try:
+            return {chat_id for chat_id, in session.query(database.Checkpoint.chat_id).all()}
+        finally:
+            session.close()
+
+    def __resume_conversation(self, chat_id: int, update: telegram.Update) -> bool:
+        """If the conversation of a chat was checkpointed before the bot was restarted, resume it in a new worker and
+        forward the update to it. Return whether the conversation was resumed."""
+        if chat_id not in self.resumable_chats:
+            return False
+        # A conversation can be resumed only once
+        self.resumable_chats.discard(chat_id)
+        session = sqlalchemy.orm.sessionmaker(bind=self.engine)()
+        try:
+            checkpoint = session.query(database.Checkpoint).filter_by(chat_id=chat_id).one_or_none()
+            if checkpoint is None:
+                return False
+            state = json.loads(checkpoint.state)
+        finally:
+            session.close()
+        log.info(f"Resuming the conversation of {chat_id} from its checkpoint")
+        chat = update.effective_chat if update.effective_chat is not None else telegram.Chat(chat_id, "private")
+        resumed_worker = worker.Worker(bot=self.bot,
+                                       chat=chat,
+                                       telegram_user=update.effective_user,
+                                       cfg=self.cfg,
+                                       engine=self.engine,
+                                       pool=self.pool,
+                                       resume=state)
+        resumed_worker.start()
+        self.chat_workers[chat_id] = resumed_worker
+        # The update is processed once the conversation has displayed the menu again
+        if update.callback_query is not None and update.callback_query.data == "cmd_cancel":
+            resumed_worker.put(worker.CancelSignal())
+            self.answer(self.bot.answer_callback_query, update.callback_query.id)
+        else:
+            resumed_worker.put(update)
+        return True
+
+    def __reject_pre_checkout_query(self, pre_checkout_query: telegram.PreCheckoutQuery):
+        """Tell the user that the invoice they are trying to pay has expired."""
+        try:
+            self.bot.answer_pre_checkout_query(pre_checkout_query.id,
+                                               ok=False,
+                                               error_message=self.default_loc.get("error_invoice_expired"))
+        except telegram.error.BadRequest:
+            log.error("pre-checkout query expired before an answer could be sent!")
+
+
+class AsyncioDispatcher(Dispatcher):
+    """A Dispatcher running on an asyncio event loop.
+    The updates are fetched and routed by two separate tasks, so that the next long-polling request is already waiting
+    while a batch is routed. The routing itself, which can query the database and create workers, runs in a thread
+    of its own, so that it never blocks the loop; the answers sent by the router are performed concurrently in a
+    thread pool, so that a slow answer never stalls the other chats."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = asyncio.new_event_loop()
+        # The answers are sent from a separate pool, so that they can never delay the long-polling requests
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.cfg["Telegram"]["dispatcher_threads"],
+                                                              thread_name_prefix="Dispatcher")
+        # The single thread routing the batches, one at a time and in order
+        self.router = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="Router")
+        # Notified by the router when routed_offset moves; created by run, as it has to belong to the running loop
+        self.__routed: Optional[asyncio.Condition] = None
+
+    def answer(self, func, *args, **kwargs):
+        """Schedule the bot method call in the thread pool and return immediately.
+        It's called by the router thread, not by the loop."""
+        future = self.executor.submit(func, *args, **kwargs)
+        future.add_done_callback(self.__log_answer_exception)
+        return future
+
+    @staticmethod
+    def __log_answer_exception(future: concurrent.futures.Future):
+        """Log the exceptions raised while answering an update, as nobody is waiting for their result."""
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            log.error(f"Exception while answering an update: {error!r}")
+
+    def run(self):
+        """Run the event loop until the bot is stopped."""
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.__run())
+        finally:
+            self.router.shutdown(wait=False)
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+
+    async def __run(self):
+        """The main coroutine of the dispatcher: run the fetching and the routing tasks until one of them fails."""
+        # The batches fetched and not routed yet; at most one batch is fetched in advance
+        batches = asyncio.Queue(maxsize=1)
+        self.__routed = asyncio.Condition()
+        tasks = [self.loop.create_task(self.__fetch_updates(batches)),
+                 self.loop.create_task(self.__route_updates(batches))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def __fetch_updates(self, batches: asyncio.Queue):
+        """Keep fetching batches of updates and put them in the batches queue, in order, like the threaded Dispatcher
+        does; the long-polling requests are made in the default executor, without blocking the loop."""
+        # The id the next fetched update should have; if None, any update is accepted
+        next_update = None
+        while True:
+            # Get a new batch of 100 updates and mark the last 100 routed as read
+            update_timeout = self.cfg["Telegram"]["long_polling_timeout"]
+            log.debug(f"Getting updates from Telegram with a timeout of {update_timeout} seconds")
+            updates = await self.loop.run_in_executor(None, functools.partial(self.get_updates,
+                                                                               offset=self.routed_offset,
+                                                                               timeout=update_timeout))
+            if self.seen_updates is not None:
+                new_updates = self.skip_seen_updates(updates)
+                if len(new_updates):
+                    await batches.put(new_updates)
+                continue
+            # Skip the updates which have already been fetched but haven't been routed yet
+            new_updates = [update for update in updates if next_update is None or update.update_id >= next_update]
+            # If only already fetched updates were received, wait for them to be routed before asking again
+            if len(updates) and not len(new_updates):
+                log.debug(f"Skipped {len(updates)} updates fetched again before being routed")
+                async with self.__routed:
+                    await self.__routed.wait_for(lambda: self.routed_offset == next_update)
+                continue
+            if len(new_updates):
+                next_update = new_updates[-1].update_id + 1
+            # Hand the batch over to the router, waiting if it is still routing the previous one
+            await batches.put(new_updates)
+
+    async def __route_updates(self, batches: asyncio.Queue):
+        """Route the batches of updates as soon as they are fetched, in the router thread."""
+        while True:
+            # Wait for the next batch; it's empty if the long polling request timed out
+            updates = await batches.get()
+            await self.loop.run_in_executor(self.router, self.__route_batch, updates)
+            # If there were any updates...
+            if len(updates):
+                # Mark them as read by increasing the update_offset
+                async with self.__routed:
+                    self.routed_offset = updates[-1].update_id + 1
+                    self.__routed.notify_all()
+
+    def __route_batch(self, updates: List[telegram.Update]):
+        """Route a batch of updates; anything slow is scheduled on the executor."""
+        # Don't hand the updates to workers which could only stall on an unreachable Telegram
+        self.wait_for_telegram()
+        for update in updates:
+            self.route(update)
+        # Periodically free the workers whose conversation has ended
+        self.reap_workers_if_due()
+
+
+class ShardSource:
+    """The source of the updates of a shard process: the updates routed to it by the ingest process."""
+
+    # The updates are pushed by the ingest process, so the offset is ignored
+    uses_offset = False
+
+    def __init__(self, bot, updates_queue: multiprocessing.Queue):
+        self.bot = bot
+        self.updates_queue = updates_queue
+
+    def get_updates(self, offset: Optional[int] = None, timeout: Optional[float] = None) -> List[telegram.Update]:
+        """Wait up to timeout seconds for at least one update, then return all the updates received so far.
+        The offset is ignored, as the ingest process has already acknowledged the updates."""
+        try:
+            data = [self.updates_queue.get(timeout=timeout)]
+        except queuem.Empty:
+            return []
+        while len(data) < 100:
+            try:
+                data.append(self.updates_queue.get_nowait())
+            except queuem.Empty:
+                break
+        # The updates are sent as dicts, and parsed here so that the ingest process doesn't have to
+        return [telegram.Update.de_json(update_data, self.bot.bot) for update_data in data]
+
+
+class ShardingDispatcher(Dispatcher):
+    """A Dispatcher splitting the updates among multiple shard processes, each one with its own workers and database
+    engine. All the updates of a chat are always sent to the same shard."""
+
+    # noinspection PyMissingConstructor
+    def __init__(self, bot, cfg: nuconfig.NuConfig, engine, default_loc: localization.Localization, source=None, *,
+                 shards: int, shard_main: Optional[Callable] = None):
+        # Only set up the fetching and the routing: the workers run in the shards, so the ingest process has no
+        # conversation pool and no checkpoints to resume
+        self.bot = bot
+        self.source = source if source is not None else bot
+        self.seen_updates: Optional[SeenUpdates] = None if getattr(self.source, "uses_offset", True) \
+            else SeenUpdates()
+        self.cfg = cfg
+        self.engine = engine
+        self.default_loc = default_loc
+        self.routed_offset: Optional[int] = None
+        self.routed_condition = threading.Condition()
+        # The function run by the shard processes, called with the config, the shard index and the updates queue
+        self.shard_main = shard_main if shard_main is not None else run_shard
+        # Shard processes are spawned, so that they don't inherit the threads and connections of this one
+        self.context = multiprocessing.get_context("spawn")
+        self.shard_queues = [self.context.Queue() for _ in range(shards)]
+        self.shard_processes = [self.__start_shard(index) for index in range(shards)]
+
+    def __start_shard(self, index: int) -> multiprocessing.Process:
+        """Start the process of a shard."""
+        log.debug(f"Starting shard {index}")
+        process = self.context.Process(target=self.shard_main,
+                                       args=(self.cfg, index, self.shard_queues[index]),
+                                       name=f"Shard {index}",
+                                       daemon=True)
+        process.start()
+        return process
+
+    @staticmethod
+    def shard_key(update: telegram.Update) -> int:
+        """Get the id all the updates belonging to the same conversation have in common.
+        It's the id of the chat, or the id of the user for the updates without one, which for private chats is the
+        same."""
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return update.effective_user.id
+
+    def route(self, update: telegram.Update):
+        """Send the update to the shard of its chat."""
+        index = self.shard_key(update) % len(self.shard_queues)
+        self.shard_queues[index].put(update.to_dict())
+
+    def reap_workers_if_due(self):
+        """The workers are reaped by the shards themselves; restart the shards that died instead."""
+        for index, process in enumerate(self.shard_processes):
+            if not process.is_alive():
+                log.error(f"Shard {index} died with exit code {process.exitcode}, restarting it")
+                self.shard_processes[index] = self.__start_shard(index)
+
+
+def run_shard(cfg: nuconfig.NuConfig, index: int, updates_queue: multiprocessing.Queue):
+    """The code of a shard process: route the updates received from the ingest process to the workers of this
+    shard."""
+    # Rename the main thread for presentation purposes
+    threading.current_thread().name = f"Shard {index}"
+    setup_logging(cfg)
+    # The tables have already been created by the ingest process
+    engine = create_engine(cfg, create_tables=False)
+    imagestore.configure(cfg)
+    imaging.configure(cfg)
+    downloads.configure(cfg)
+    bot = duckbot.factory(cfg)()
+    default_loc = localization.Localization(language=cfg["Language"]["default_language"],
+                                            fallback=cfg["Language"]["default_language"])
+    dispatcher = create_dispatcher(bot=bot, cfg=cfg, engine=engine, default_loc=default_loc,
+                                   source=ShardSource(bot, updates_queue))
+    log.debug(f"Shard {index} is starting!")
+    dispatcher.run()
+
+
+def setup_logging(cfg: nuconfig.NuConfig):
+    """Set up the logging as specified in the config."""
+    logging.root.setLevel(cfg["Logging"]["level"])
+    stream_handler = logging.StreamHandler()
+    if coloredlogs is not None:
+        stream_handler.formatter = coloredlogs.ColoredFormatter(cfg["Logging"]["format"], style="{")
+    else:
+        stream_handler.formatter = logging.Formatter(cfg["Logging"]["format"], style="{")
+    logging.root.handlers.clear()
+    logging.root.addHandler(stream_handler)
+    log.debug("Logging setup successfully!")
+
+    # Ignore most python-telegram-bot logs, as they are useless most of the time
+    logging.getLogger("telegram").setLevel("ERROR")
+
+
+def create_engine(cfg: nuconfig.NuConfig, create_tables: bool = True):
+    """Create the database engine and prepare the tables."""
+    log.debug("Creating the sqlalchemy engine...")
+    engine = sqlalchemy.create_engine(cfg["Database"]["engine"])
+    log.debug("Binding metadata to the engine...")
+    database.TableDeclarativeBase.metadata.bind = engine
+    if create_tables:
+        log.debug("Creating all missing tables...")
+        database.TableDeclarativeBase.metadata.create_all()
+        log.debug("Adding all missing columns...")
+        database.add_missing_columns(engine)
+    log.debug("Preparing the tables through deferred reflection...")
+    sed.DeferredReflection.prepare(engine)
+    return engine
+
+
+def create_dispatcher(bot, cfg: nuconfig.NuConfig, engine, default_loc: localization.Localization, source=None):
+    """Create the Dispatcher selected in the config."""
+    if cfg["Telegram"]["dispatcher"] == "asyncio":
+        return AsyncioDispatcher(bot=bot, cfg=cfg, engine=engine, default_loc=default_loc, source=source)
+    else:
+        return Dispatcher(bot=bot, cfg=cfg, engine=engine, default_loc=default_loc, source=source)
+
+
 def main():
     """The core code of the program. Should be run only in the main process!"""
     # Rename the main thread for presentation purposes
     threading.current_thread().name = "Core"
 
     # Start logging setup
-    log = logging.getLogger("core")
     logging.root.setLevel("INFO")
     log.debug("Set logging level to INFO while the config is being loaded")
 
@@ -60,28 +681,15 @@ def main():
             log.debug("Configuration parsed successfully!")
 
     # Finish logging setup
-    logging.root.setLevel(user_cfg["Logging"]["level"])
-    stream_handler = logging.StreamHandler()
-    if coloredlogs is not None:
-        stream_handler.formatter = coloredlogs.ColoredFormatter(user_cfg["Logging"]["format"], style="{")
-    else:
-        stream_handler.formatter = logging.Formatter(user_cfg["Logging"]["format"], style="{")
-    logging.root.handlers.clear()
-    logging.root.addHandler(stream_handler)
-    log.debug("Logging setup successfully!")
-
-    # Ignore most python-telegram-bot logs, as they are useless most of the time
-    logging.getLogger("telegram").setLevel("ERROR")
+    setup_logging(user_cfg)
 
     # Create the database engine
-    log.debug("Creating the sqlalchemy engine...")
-    engine = sqlalchemy.create_engine(user_cfg["Database"]["engine"])
-    log.debug("Binding metadata to the engine...")
-    database.TableDeclarativeBase.metadata.bind = engine
-    log.debug("Creating all missing tables...")
-    database.TableDeclarativeBase.metadata.create_all()
-    log.debug("Preparing the tables through deferred reflection...")
-    sed.DeferredReflection.prepare(engine)
+    engine = create_engine(user_cfg)
+
+    # Open the store of the product images, and start the pools downloading and normalising them
+    imagestore.configure(user_cfg)
+    imaging.configure(user_cfg)
+    downloads.configure(user_cfg)
 
     # Create a bot instance
     bot = duckbot.factory(user_cfg)()
@@ -99,132 +707,31 @@ def main():
     # Creating localization object
     default_loc = localization.Localization(language=default_language, fallback=default_language)
 
-    # Create a dictionary linking the chat ids to the Worker objects
-    # {"1234": <Worker>}
-    chat_workers = {}
+    # If the webhook is enabled, receive the updates through the embedded HTTP server
+    if user_cfg["Telegram"]["Webhook"]["enabled"]:
+        source = webhook.WebhookServer(bot=bot, cfg=user_cfg)
+        source.start()
+    # Otherwise, long-poll Telegram, ensuring no webhook is left over from a previous run
+    else:
+        bot.delete_webhook()
+        source = bot
+    # Record the received updates, so that they can be replayed later
+    if user_cfg["Telegram"]["record_updates"]:
+        source = recording.RecordingSource(source, user_cfg["Telegram"]["record_updates"],
+                                           salt=user_cfg["Telegram"]["record_salt"])
 
-    # Current update offset; if None it will get the last 100 unparsed messages
-    next_update = None
+    # Create the dispatcher that will route the updates to the workers, or to the shards running them
+    if user_cfg["Telegram"]["shards"] > 1:
+        dispatcher = ShardingDispatcher(bot=bot, cfg=user_cfg, engine=engine, default_loc=default_loc, source=source,
+                                        shards=user_cfg["Telegram"]["shards"])
+    else:
+        dispatcher = create_dispatcher(bot=bot, cfg=user_cfg, engine=engine, default_loc=default_loc, source=source)
 
     # Notify on the console that the bot is starting
     log.info(f"@{me.username} is starting!")
 
     # Main loop of the program
-    while True:
-        # Get a new batch of 100 updates and mark the last 100 parsed as read
-        update_timeout = user_cfg["Telegram"]["long_polling_timeout"]
-        log.debug(f"Getting updates from Telegram with a timeout of {update_timeout} seconds")
-        updates = bot.get_updates(offset=next_update,
-                                  timeout=update_timeout)
-        # Parse all the updates
-        for update in updates:
-            # If the update is a message...
-            if update.message is not None:
-                # Ensure the message has been sent in a private chat
-                if update.message.chat.type != "private":
-                    # if update.message.chat.id != "123":
-                    log.debug(f"Received a message from a non-private chat: {update.message.chat.id}")
-                    # Notify the chat
-                    bot.send_message(update.message.chat.id, default_loc.get("error_nonprivate_chat"))
-                    # Skip the update
-                    continue
-                # If the message is a start command...
-                if isinstance(update.message.text, str) and update.message.text.startswith("/start"):
-                    log.info(f"Received /start from: {update.message.chat.id}")
-                    # Check if a worker already exists for that chat
-                    old_worker = chat_workers.get(update.message.chat.id)
-                    # If it exists, gracefully stop the worker
-                    if old_worker:
-                        log.debug(f"Received request to stop {old_worker.name}")
-                        old_worker.stop("request")
-                    # Initialize a new worker for the chat
-                    new_worker = worker.Worker(bot=bot,
-                                               chat=update.message.chat,
-                                               telegram_user=update.message.from_user,
-                                               cfg=user_cfg,
-                                               engine=engine,
-                                               daemon=True)
-                    # Start the worker
-                    log.debug(f"Starting {new_worker.name}")
-                    new_worker.start()
-                    # Store the worker in the dictionary
-                    chat_workers[update.message.chat.id] = new_worker
-                    # Skip the update
-                    continue
-                # Otherwise, forward the update to the corresponding worker
-                receiving_worker = chat_workers.get(update.message.chat.id)
-                # Ensure a worker exists for the chat and is alive
-                if receiving_worker is None:
-                    log.debug(f"Received a message in a chat without worker: {update.message.chat.id}")
-                    # Suggest that the user restarts the chat with /start
-                    bot.send_message(update.message.chat.id, default_loc.get("error_no_worker_for_chat"),
-                                     reply_markup=telegram.ReplyKeyboardRemove())
-                    # Skip the update
-                    continue
-                # If the worker is not ready...
-                if not receiving_worker.is_ready():
-                    log.debug(f"Received a message in a chat where the worker wasn't ready yet: {update.message.chat.id}")
-                    # Suggest that the user restarts the chat with /start
-                    bot.send_message(update.message.chat.id, default_loc.get("error_worker_not_ready"),
-                                     reply_markup=telegram.ReplyKeyboardRemove())
-                    # Skip the update
-                    continue
-                # If the message contains the "Cancel" string defined in the strings file...
-                if update.message.text == receiving_worker.loc.get("menu_cancel"):
-                    log.debug(f"Forwarding CancelSignal to {receiving_worker}")
-                    # Send a CancelSignal to the worker instead of the update
-                    receiving_worker.queue.put(worker.CancelSignal())
-                else:
-                    log.debug(f"Forwarding message to {receiving_worker}")
-                    # Forward the update to the worker
-                    receiving_worker.queue.put(update)
-            # If the update is a inline keyboard press...
-            if isinstance(update.callback_query, telegram.CallbackQuery):
-                # Forward the update to the corresponding worker
-                receiving_worker = chat_workers.get(update.callback_query.from_user.id)
-                # Ensure a worker exists for the chat
-                if receiving_worker is None:
-                    log.debug(
-                        f"Received a callback query in a chat without worker: {update.callback_query.from_user.id}")
-                    # Suggest that the user restarts the chat with /start
-                    bot.send_message(update.callback_query.from_user.id, default_loc.get("error_no_worker_for_chat"))
-                    # Skip the update
-                    continue
-                # Check if the pressed inline key is a cancel button
-                if update.callback_query.data == "cmd_cancel":
-                    log.debug(f"Forwarding CancelSignal to {receiving_worker}")
-                    # Forward a CancelSignal to the worker
-                    receiving_worker.queue.put(worker.CancelSignal())
-                    # Notify the Telegram client that the inline keyboard press has been received
-                    bot.answer_callback_query(update.callback_query.id)
-                else:
-                    log.debug(f"Forwarding callback query to {receiving_worker}")
-                    # Forward the update to the worker
-                    receiving_worker.queue.put(update)
-            # If the update is a precheckoutquery, ensure it hasn't expired before forwarding it
-            if isinstance(update.pre_checkout_query, telegram.PreCheckoutQuery):
-                # Forward the update to the corresponding worker
-                receiving_worker = chat_workers.get(update.pre_checkout_query.from_user.id)
-                # Check if it's the active invoice for this chat
-                if receiving_worker is None or \
-                        update.pre_checkout_query.invoice_payload != receiving_worker.invoice_payload:
-                    # Notify the user that the invoice has expired
-                    log.debug(f"Received a pre-checkout query for an expired invoice in: {update.pre_checkout_query.from_user.id}")
-                    try:
-                        bot.answer_pre_checkout_query(update.pre_checkout_query.id,
-                                                      ok=False,
-                                                      error_message=default_loc.get("error_invoice_expired"))
-                    except telegram.error.BadRequest:
-                        log.error("pre-checkout query expired before an answer could be sent!")
-                    # Go to the next update
-                    continue
-                log.debug(f"Forwarding pre-checkout query to {receiving_worker}")
-                # Forward the update to the worker
-                receiving_worker.queue.put(update)
-        # If there were any updates...
-        if len(updates):
-            # Mark them as read by increasing the update_offset
-            next_update = updates[-1].update_id + 1
+    dispatcher.run()
 
 
 # Run the main function only in the main process
@@ -1,13 +1,18 @@
+import io
 import logging
 import typing
 
-import requests
+import sqlalchemy
+import sqlalchemy.orm
 import telegram
 from sqlalchemy import Column, ForeignKey, UniqueConstraint, VARCHAR, Float
 from sqlalchemy import Integer, BigInteger, String, Text, LargeBinary, DateTime, Boolean
 from sqlalchemy.ext.declarative import declarative_base, DeferredReflection
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, deferred, column_property
+from sqlalchemy.orm.attributes import set_committed_value
 
+import imagestore
+import imaging
 import utils
 
 if typing.TYPE_CHECKING:
@@ -138,8 +143,16 @@ class Product(DeferredReflection, TableDeclarativeBase):
     description = Column(Text)
     # Product price, if null product is not for sale
     price = Column(Integer)
-    # Image data
-    image = Column(LargeBinary)
+    # Image data, loaded only when accessed, as the catalog queries don't need it
+    image = deferred(Column(LargeBinary))
+    # Hash of the image in the image store, if it's stored there instead of in the image column
+    image_hash = Column(String)
+    # Whether the product has an image, loaded with the product instead of the image itself
+    has_image = column_property(sqlalchemy.or_(image.columns[0].isnot(None), image_hash.isnot(None)))
+    # A small version of the image, loaded only when accessed
+    thumbnail = deferred(Column(LargeBinary))
+    # The file_id Telegram assigned to the image, to send it again without uploading it
+    image_file_id = Column(String)
     # Product has been deleted
     deleted = Column(Boolean, nullable=False)
     # Multiple sizes of product
@@ -190,28 +203,62 @@ class Product(DeferredReflection, TableDeclarativeBase):
     def __repr__(self):
         return f"<Product {self.name}>"
 
-    def send_as_message(self, w: "worker.Worker", chat_id: int, session: dict = None) -> dict:
-        """Send a message containing the product data."""
-        if self.image is None:
-            r = requests.get(f"https://api.telegram.org/bot{w.cfg['Telegram']['token']}/sendMessage",
-                             params={"chat_id": chat_id,
-                                     "text": self.text(w, session=session),
-                                     "parse_mode": "HTML"})
+    def send_as_message(self, w: "worker.Worker", chat_id: int, session: dict = None,
+                        text: str = None) -> telegram.Message:
+        """Send a message containing the product data, or the text specified.
+        The image is uploaded only the first time, then it's sent through the file_id Telegram assigned to it."""
+        if text is None:
+            text = self.text(w, session=session)
+        if not self.has_image:
+            return w.bot.send_message(chat_id, text)
+        if self.image_file_id is not None:
+            try:
+                return w.bot.send_photo(chat_id,
+                                        photo=self.image_file_id,
+                                        caption=text)
+            # The file_id isn't valid anymore, for example because the bot token has changed
+            except telegram.error.BadRequest:
+                log.warning(f"The image file_id of {self} is invalid, uploading the image again")
+        # Only now the image is loaded, and it's released as soon as it's uploaded
+        with self.open_image() as image:
+            message = w.bot.send_photo(chat_id,
+                                       photo=image,
+                                       caption=text)
+        if message is not None and message.photo:
+            self.remember_image_file_id(message.photo[-1].file_id)
+        return message
+
+    def open_image(self) -> typing.ContextManager[typing.BinaryIO]:
+        """Open the image, from the image store if it's stored there, or else from the image column.
+        Use it in a with statement, which releases the image at its end."""
+        if self.image_hash is not None:
+            # The file is memory mapped, its content isn't copied here
+            return imagestore.store.open(self.image_hash)
+        return io.BytesIO(self.image)
+
+    def remember_image_file_id(self, file_id: str):
+        """Store the file_id of the image in its own transaction, without committing the other changes of the session
+        the product belongs to."""
+        session = sqlalchemy.orm.Session(bind=sqlalchemy.orm.object_session(self).get_bind())
+        try:
+            session.query(Product).filter_by(id=self.id).update({"image_file_id": file_id})
+            session.commit()
+        finally:
+            session.close()
+        # Update the loaded product without marking it as changed
+        set_committed_value(self, "image_file_id", file_id)
+
+    def store_image(self, image: imaging.ProcessedImage):
+        """Store a processed image in the image store, or in the image column if there is none."""
+        if imagestore.store is not None:
+            # Store only the hash of the photo in the database record
+            self.image_hash = imagestore.store.put(image.data)
+            self.image = None
         else:
-            r = requests.post(f"https://api.telegram.org/bot{w.cfg['Telegram']['token']}/sendPhoto",
-                              files={"photo": self.image},
-                              params={"chat_id": chat_id,
-                                      "caption": self.text(w, session=session),
-                                      "parse_mode": "HTML"})
-        return r.json()
-
-    def set_image(self, file: telegram.File):
-        """Download an image from Telegram and store it in the image column.
-        This is a slow blocking function. Try to avoid calling it directly, use a thread if possible."""
-        # Download the photo through a get request
-        r = requests.get(file.file_path)
-        # Store the photo in the database record
-        self.image = r.content
+            # Store the photo in the database record
+            self.image = image.data
+            self.image_hash = None
+        self.thumbnail = image.thumbnail
 
 
 class Admin(DeferredReflection, TableDeclarativeBase):
@@ -303,3 +350,40 @@ class OrderItem(DeferredReflection, TableDeclarativeBase):
 
     def __repr__(self):
         return f"<OrderItem {self.item_id}>"
+
+
+class Checkpoint(DeferredReflection, TableDeclarativeBase):
+    """The state of an order being placed, saved every time the conversation waits for the user,
+    so that it can be resumed if the bot is restarted."""
+
+    # The chat of the conversation
+    chat_id = Column(BigInteger, primary_key=True)
+    # The state of the conversation, encoded in JSON
+    state = Column(Text, nullable=False)
+    # Date of the last save
+    update_date = Column(DateTime, nullable=False)
+
+    # Extra table parameters
+    __tablename__ = "checkpoints"
+
+    def __repr__(self):
+        return f"<Checkpoint of chat {self.chat_id}>"
+
+
+def add_missing_columns(engine):
+    """Add to the existing tables the columns added to the models after the tables were created, as create_all only
+    creates the missing tables.
+    Only nullable columns can be added; the others have to be added by hand."""
+    inspector = sqlalchemy.inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    for table in TableDeclarativeBase.metadata.sorted_tables:
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            if not column.nullable:
+                log.error(f"The column {table.name}.{column.name} is missing and can't be added automatically")
+                continue
+            log.info(f"Adding the missing column {table.name}.{column.name}")
+            engine.execute(f"ALTER TABLE {quote(table.name)}"
+                           f" ADD COLUMN {quote(column.name)} {column.type.compile(dialect=engine.dialect)}")
@@ -0,0 +1,80 @@
+import concurrent.futures
+import logging
+import os
+import tempfile
+import time
+from typing import *
+
+import certifi
+import telegram
+from telegram.vendor.ptb_urllib3 import urllib3
+
+import nuconfig
+
+log = logging.getLogger(__name__)
+
+# A function called while a file is downloaded, with the bytes downloaded so far and the size of the file, if known
+ProgressCallback = Callable[[int, Optional[int]], None]
+
+
+class DownloadTimeout(Exception):
+    """The download of a file took longer than the configured timeout."""
+
+
+class Downloader:
+    """Download files from Telegram in the background, in a bounded pool of threads and connections.
+    The files are streamed to temporary files on disk in chunks, so that they are never entirely in memory."""
+
+    def __init__(self, cfg: nuconfig.NuConfig):
+        settings = cfg["Images"]["Downloads"]
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings["threads"],
+                                                              thread_name_prefix="Download")
+        # One connection for every thread, reused by the downloads from the same host
+        self.pool = urllib3.PoolManager(maxsize=settings["threads"], block=True,
+                                        cert_reqs="CERT_REQUIRED", ca_certs=certifi.where())
+        self.chunk_size: int = settings["chunk_size"]
+        self.timeout: float = settings["timeout"]
+
+    def submit(self, func, *args, **kwargs) -> concurrent.futures.Future:
+        """Run a function in one of the threads of the pool."""
+        return self.executor.submit(func, *args, **kwargs)
+
+    def download(self, file: telegram.File, progress: Optional[ProgressCallback] = None) -> str:
+        """Download a file to a temporary file, and return its path; the caller has to delete it.
+        This is a slow blocking function, call it in the pool through submit."""
+        deadline = time.monotonic() + self.timeout
+        # No single connection or read can wait longer than the whole download; the deadline is checked between chunks
+        response = self.pool.request("GET", file.file_path, preload_content=False,
+                                     timeout=urllib3.Timeout(total=self.timeout), retries=False)
+        try:
+            if response.status != 200:
+                raise telegram.error.NetworkError(f"Downloading {file.file_id} failed with HTTP {response.status}")
+            size = file.file_size or int(response.headers.get("Content-Length", 0)) or None
+            descriptor, path = tempfile.mkstemp(prefix="greed-", suffix=".download")
+            try:
+                with os.fdopen(descriptor, "wb") as output:
+                    downloaded = 0
+                    for chunk in response.stream(self.chunk_size):
+                        output.write(chunk)
+                        downloaded += len(chunk)
+                        if progress is not None:
+                            progress(downloaded, size)
+                        if time.monotonic() > deadline:
+                            raise DownloadTimeout(f"Downloading {file.file_id} took longer than {self.timeout} secs")
+            except BaseException:
+                os.unlink(path)
+                raise
+        finally:
+            response.release_conn()
+        log.debug(f"Downloaded {downloaded} bytes of {file.file_id} to {path}")
+        return path
+
+
+# The downloader of this process
+downloader: Optional[Downloader] = None
+
+
+def configure(cfg: nuconfig.NuConfig):
+    """Create the downloader with the settings of the config."""
+    global downloader
+    downloader = Downloader(cfg)
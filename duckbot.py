@@ -1,122 +1,807 @@
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import functools
+import json
 import logging
+import random
 import sys
+import threading
 import time
 import traceback
+from typing import *
 
 import telegram.error
+import telegram.utils.request
 
+import broadcast
 import nuconfig
 
 log = logging.getLogger(__name__)
 
 
+class TokenBucket:
+    """A bucket of capacity tokens, refilled with rate tokens every second."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.timestamp: float = time.monotonic()
+        # Nothing can be taken from the bucket before this time
+        self.blocked_until: float = 0.0
+
+    def refill(self, now: float):
+        """Add the tokens accumulated since the last refill."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def refill_wait(self, now: float) -> float:
+        """Get how many seconds a token taken now would have to wait to be refilled, without taking it."""
+        self.refill(now)
+        return (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+
+    def reserve(self, now: float) -> float:
+        """Take a token, and return how many seconds have to pass before it can be used.
+        The tokens can go below zero: the following reservations will have to wait for them to be refilled."""
+        self.refill(now)
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def is_full(self, now: float) -> bool:
+        """Check if the bucket would be full, and could therefore be recreated without any difference."""
+        return self.blocked_until <= now and self.tokens + (now - self.timestamp) * self.rate >= self.capacity
+
+
+class RateLimiter:
+    """Delay the messages sent by the bot to stay within the flood limits of Telegram: a global limit, a limit for
+    every private chat and a lower one for every group and channel.
+    A single RateLimiter is shared by all the threads of the process. With more than one shard, every process has its
+    own: the global and the channel limits, which all the shards share, are split evenly among them, while the private
+    chat limits are kept, as every chat is handled by a single shard.
+    Only the new messages count against the limits of their chat; the edits only count against the global limit.
+    A message which would wait more than chat_max_wait seconds for the limit of its chat isn't sent, and raises a
+    RateLimitExceeded instead, so that a chat flooding the bot can't keep its threads sleeping; the flood limits set
+    by Telegram are waited for anyway."""
+
+    def __init__(self, cfg: nuconfig.NuConfig):
+        limits = cfg["Telegram"]["RateLimits"]
+        shards = max(cfg["Telegram"]["shards"], 1)
+        global_rate = limits["global_per_second"] / shards
+        self.global_bucket = TokenBucket(rate=global_rate, capacity=max(global_rate, 1))
+        self.chat_rate: float = limits["chat_per_second"]
+        self.channel_rate: float = limits["channel_per_minute"] / 60 / shards
+        self.burst: int = limits["chat_burst"]
+        self.channel_burst: int = max(limits["chat_burst"] // shards, 1)
+        self.chat_max_wait: float = limits["chat_max_wait"]
+        # The channels of the bot; they may be specified as usernames, so they can't always be told apart by their id
+        self.channels = {str(cfg["Administration"]["orders_channel"]), str(cfg["Administration"]["rates_channel"])}
+        # The buckets of the chats the bot has recently sent messages to
+        self.chat_buckets: Dict[str, TokenBucket] = {}
+        self.last_prune: float = time.monotonic()
+        self.lock = threading.Lock()
+
+    def is_channel(self, chat_id) -> bool:
+        """Check if a chat id belongs to a group or a channel, which have lower limits than private chats."""
+        chat_id = str(chat_id)
+        return chat_id in self.channels or chat_id.startswith("-") or chat_id.startswith("@")
+
+    def __chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        """Get the bucket of a chat, creating it if it doesn't exist."""
+        # Forget the chats whose bucket is full, as it would be recreated identical
+        if now - self.last_prune > 60:
+            self.chat_buckets = {key: bucket for key, bucket in self.chat_buckets.items() if not bucket.is_full(now)}
+            self.last_prune = now
+        key = str(chat_id)
+        bucket = self.chat_buckets.get(key)
+        if bucket is None:
+            if self.is_channel(chat_id):
+                bucket = TokenBucket(rate=self.channel_rate, capacity=self.channel_burst)
+            else:
+                bucket = TokenBucket(rate=self.chat_rate, capacity=self.burst)
+            self.chat_buckets[key] = bucket
+        return bucket
+
+    def acquire(self, chat_id=None, per_chat: bool = True):
+        """Block until a message can be sent to the specified chat.
+        If per_chat is False, the call doesn't count against the limit of the chat, but it still waits for the chat
+        to be unblocked after a flood limit."""
+        with self.lock:
+            now = time.monotonic()
+            chat_wait = 0.0
+            if chat_id is not None:
+                bucket = self.__chat_bucket(chat_id, now)
+                # The flood limits set by Telegram are always waited for
+                chat_wait = bucket.blocked_until - now
+                if per_chat:
+                    refill_wait = bucket.refill_wait(now)
+                    if refill_wait > self.chat_max_wait:
+                        raise RateLimitExceeded(chat_id, refill_wait)
+                    chat_wait = max(chat_wait, bucket.reserve(now))
+            wait = max(self.global_bucket.reserve(now), chat_wait)
+        if wait > 0:
+            log.debug(f"Waiting {wait:.2f} secs to stay within the rate limits of chat {chat_id}")
+            time.sleep(wait)
+
+    def retry_after(self, chat_id, seconds: float):
+        """Block a chat, or all the chats if it's None, for the time requested by Telegram in a RetryAfter error."""
+        with self.lock:
+            now = time.monotonic()
+            bucket = self.__chat_bucket(chat_id, now) if chat_id is not None else self.global_bucket
+            bucket.blocked_until = max(bucket.blocked_until, now + seconds)
+
+
+class RateLimitExceeded(telegram.error.TelegramError):
+    """A message was refused without being sent, as it would have waited too long for the rate limit of its chat."""
+
+    def __init__(self, chat_id, wait: float):
+        super().__init__(f"Rate limit of chat {chat_id} exceeded, the message would wait {wait:.1f} secs")
+
+
+class CircuitOpenError(telegram.error.NetworkError):
+    """A call to the Bot API was refused without being made, as Telegram is unreachable."""
+
+    def __init__(self):
+        super().__init__("Circuit breaker is open")
+
+
+class CircuitBreaker:
+    """Stop calling the Bot API from every thread while Telegram is unreachable.
+    The circuit opens after failure_threshold consecutive network errors. While it's open, the calls wait for it to
+    close or, in "fail" mode, raise a CircuitOpenError immediately. After reset_timeout seconds a single call is let
+    through as a probe: if it succeeds the circuit closes, otherwise it opens again.
+    A single CircuitBreaker is shared by all the threads of the process."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, cfg: nuconfig.NuConfig):
+        breaker = cfg["Telegram"]["CircuitBreaker"]
+        self.failure_threshold: int = breaker["failure_threshold"]
+        self.reset_timeout: float = breaker["reset_timeout"]
+        self.fail_fast: bool = breaker["mode"] == "fail"
+        self.state: str = self.CLOSED
+        # The consecutive network errors while the circuit is closed
+        self.failures: int = 0
+        self.opened_at: float = 0.0
+        # Whether a probe call is in progress while the circuit is half-open
+        self.probing: bool = False
+        self.condition = threading.Condition()
+
+    def is_closed(self) -> bool:
+        """Check if Telegram is believed to be reachable."""
+        return self.state == self.CLOSED
+
+    def wait_closed(self, timeout: Optional[float] = None) -> bool:
+        """Wait up to timeout seconds for the circuit to close, and return whether it did."""
+        with self.condition:
+            return self.condition.wait_for(self.is_closed, timeout=timeout)
+
+    def before_call(self):
+        """Wait until a call can be made, or raise a CircuitOpenError in fail mode."""
+        with self.condition:
+            while True:
+                if self.state == self.CLOSED:
+                    return
+                remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                if self.state == self.OPEN and remaining <= 0:
+                    log.info("Probing the Telegram API...")
+                    self.state = self.HALF_OPEN
+                # Let a single call through as a probe
+                if self.state == self.HALF_OPEN and not self.probing:
+                    self.probing = True
+                    return
+                if self.fail_fast:
+                    raise CircuitOpenError()
+                # Wait for the probe to be due, or for its result
+                self.condition.wait(timeout=remaining if self.state == self.OPEN else None)
+
+    def success(self):
+        """Report that Telegram answered a call, even with an error."""
+        with self.condition:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                log.info("The Telegram API is reachable again, closing the circuit breaker")
+                self.state = self.CLOSED
+                self.probing = False
+                self.condition.notify_all()
+
+    def failure(self):
+        """Report that a call couldn't reach Telegram."""
+        with self.condition:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                log.error(f"The Telegram API is unreachable, opening the circuit breaker"
+                          f" for {self.reset_timeout} secs")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.probing = False
+                self.condition.notify_all()
+
+    def abort(self):
+        """Report that a call ended without telling if Telegram is reachable, letting another call probe it."""
+        with self.condition:
+            if self.state == self.HALF_OPEN and self.probing:
+                self.probing = False
+                self.condition.notify_all()
+
+
+class RetryPolicy:
+    """Decide how long to wait before retrying a failed call to the Bot API, and when to give up.
+    The delays grow exponentially up to a cap, and are picked at random up to that value ("full jitter"), so that the
+    threads which failed together during an outage don't all retry together when it ends."""
+
+    def __init__(self, cfg: nuconfig.NuConfig):
+        retry = cfg["Telegram"]["Retry"]
+        self.max_delay: float = retry["max_delay"]
+        self.max_retries: int = retry["max_retries"]
+        # The methods with a different number of retries than the default one
+        self.method_retries: Dict[str, int] = retry["Methods"]
+
+    def retries(self, name: str) -> int:
+        """Get how many times a method can be retried, or -1 if it should be retried forever."""
+        return self.method_retries.get(name, self.max_retries)
+
+    def exhausted(self, name: str, attempt: int) -> bool:
+        """Check if a method which has already failed attempt times shouldn't be retried anymore."""
+        retries = self.retries(name)
+        return retries != -1 and attempt > retries
+
+    def delay(self, base: float, attempt: int) -> float:
+        """Get the seconds to wait after the attempt-th consecutive failure of a call, starting from 1."""
+        return random.uniform(0, min(self.max_delay, base * 2 ** (attempt - 1)))
+
+
+class OutboundCall:
+    """A call to the Bot API waiting in an Outbox."""
+
+    def __init__(self, name: str, func: Callable, message_id: Optional[int]):
+        self.name: str = name
+        self.func: Callable = func
+        # The message the call acts on, if any
+        self.message_id: Optional[int] = message_id
+        self.future = concurrent.futures.Future()
+
+
+class Outbox:
+    """Make the calls to the Bot API of every chat from a thread pool, one at a time and in the order they were
+    submitted, dropping the ones made useless by a later call before they are made:
+    an edit replaces a pending edit of the same kind of the same message, and a deletion drops all the pending edits
+    of the message it deletes."""
+
+    # The methods superseded by a later call of the same method on the same message
+    COALESCED = {"edit_message_text", "edit_message_caption", "edit_message_reply_markup"}
+
+    def __init__(self, threads: int):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="Outbox")
+        # The calls waiting to be made, for every chat whose calls are being made
+        self.chats: Dict[str, Deque[OutboundCall]] = {}
+        self.lock = threading.Lock()
+        # The number of calls dropped because of a later call
+        self.coalesced: int = 0
+
+    def submit(self, chat_id, name: str, func: Callable, message_id: Optional[int] = None) -> concurrent.futures.Future:
+        """Queue a call of the name method in the chat, and return a future of its result.
+        If chat_id is None, the call isn't ordered with any other.
+        The future of a dropped call has a None result."""
+        call = OutboundCall(name, func, message_id)
+        # The calls not bound to a chat have a queue of their own
+        key = str(chat_id) if chat_id is not None else f"call {id(call)}"
+        dropped = []
+        with self.lock:
+            pending = self.chats.get(key)
+            # Start making the calls of the chat if there's none in progress
+            start = pending is None
+            if start:
+                pending = self.chats[key] = collections.deque()
+            if message_id is not None:
+                for queued in pending:
+                    if queued.message_id != message_id or queued.name not in self.COALESCED:
+                        continue
+                    if queued.name == name or name == "delete_message":
+                        dropped.append(queued)
+                for queued in dropped:
+                    pending.remove(queued)
+                self.coalesced += len(dropped)
+            pending.append(call)
+        for queued in dropped:
+            log.debug(f"Dropping {queued.name}() of message {message_id} in chat {chat_id}, superseded by {name}()")
+            queued.future.set_result(None)
+        if start:
+            self.executor.submit(self.__make_calls, key)
+        return call.future
+
+    def call(self, chat_id, name: str, func: Callable, message_id: Optional[int] = None):
+        """Make a call of the name method in the chat from the current thread, after the calls of the chat already
+        queued, and return its result.
+        If the chat has no calls in progress the call is made at once, and the calls submitted meanwhile wait for it,
+        so that the calls of the chat stay in order without moving to another thread."""
+        if chat_id is None:
+            return func()
+        key = str(chat_id)
+        with self.lock:
+            inline = key not in self.chats
+            # Take the place of the thread making the calls of the chat
+            if inline:
+                self.chats[key] = collections.deque()
+        if not inline:
+            return self.submit(chat_id, name, func, message_id).result()
+        try:
+            return func()
+        finally:
+            with self.lock:
+                pending = self.chats[key]
+                if not pending:
+                    del self.chats[key]
+            # Make the calls submitted meanwhile
+            if pending:
+                self.executor.submit(self.__make_calls, key)
+
+    def __make_calls(self, key: str):
+        """Make the calls of a chat until there's none left."""
+        while True:
+            with self.lock:
+                pending = self.chats[key]
+                if not pending:
+                    del self.chats[key]
+                    return
+                call = pending.popleft()
+            if not call.future.set_running_or_notify_cancel():
+                continue
+            try:
+                call.future.set_result(call.func())
+            except Exception as error:
+                call.future.set_exception(error)
+
+
+class MethodMetrics:
+    """The latencies, retries and errors of the calls of a bot method."""
+
+    # The upper bounds in seconds of the buckets of the latency histogram
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+    def __init__(self):
+        # The number of attempts, including the retries and the ones that failed
+        self.attempts: int = 0
+        self.retries: int = 0
+        self.total_time: float = 0.0
+        self.max_time: float = 0.0
+        self.histogram: List[int] = [0] * len(self.BUCKETS)
+        # The number of failed attempts, by error class
+        self.errors: Dict[str, int] = collections.Counter()
+
+    def observe(self, seconds: float, error: Optional[Exception] = None):
+        self.attempts += 1
+        self.total_time += seconds
+        self.max_time = max(self.max_time, seconds)
+        self.histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        if error is not None:
+            self.errors[error.__class__.__name__] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """Get the upper bound of the bucket containing the requested percentile of the latencies."""
+        threshold = fraction * self.attempts
+        count = 0
+        for bound, bucket in zip(self.BUCKETS, self.histogram):
+            count += bucket
+            if count >= threshold:
+                return min(bound, self.max_time)
+        return self.max_time
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "mean": self.total_time / self.attempts if self.attempts else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max_time,
+            "histogram": {str(bound): bucket for bound, bucket in zip(self.BUCKETS, self.histogram)},
+            "errors": dict(self.errors),
+        }
+
+
+class Metrics:
+    """The metrics of the calls to the Bot API made by all the threads of the process, by method."""
+
+    def __init__(self):
+        self.methods: Dict[str, MethodMetrics] = collections.defaultdict(MethodMetrics)
+        self.lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float, error: Optional[Exception] = None):
+        """Record an attempt to call a method, which took seconds and failed if error isn't None."""
+        with self.lock:
+            self.methods[name].observe(seconds, error)
+
+    def retry(self, name: str):
+        """Record that a failed call of a method is going to be retried."""
+        with self.lock:
+            self.methods[name].retries += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Get the current metrics of every method called so far."""
+        with self.lock:
+            return {name: method.to_dict() for name, method in sorted(self.methods.items())}
+
+    def format(self) -> str:
+        """Format the current metrics as a table."""
+        lines = [f"{'method':<28} {'attempts':>8} {'retries':>7} {'mean':>7} {'p50':>7} {'p95':>7} {'p99':>7}"
+                 f" {'max':>7}  errors"]
+        for name, method in self.snapshot().items():
+            errors = ", ".join(f"{error}: {count}" for error, count in method["errors"].items())
+            lines.append(f"{name:<28} {method['attempts']:>8} {method['retries']:>7} {method['mean']:>7.3f}"
+                         f" {method['p50']:>7.3f} {method['p95']:>7.3f} {method['p99']:>7.3f} {method['max']:>7.3f}"
+                         f"  {errors}")
+        return "\n".join(lines)
+
+
+def get_message_id(name: str, args, kwargs) -> Optional[int]:
+    """Get the message_id a bot method is called with, or None if it isn't bound to a message."""
+    if "message_id" in kwargs:
+        return kwargs["message_id"]
+    # In delete_message, message_id is the second positional argument
+    if name == "delete_message" and len(args) > 1:
+        return args[1]
+    return None
+
+
+def log_call_failure(future: concurrent.futures.Future):
+    """Log the failure of a call whose result nobody is waiting for."""
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        log.error(f"A call to Telegram failed in the background: {error!r}")
+
+
+def get_chat_id(name: str, args, kwargs):
+    """Get the chat_id a bot method is called with, or None if it isn't bound to a chat."""
+    if "chat_id" in kwargs:
+        return kwargs["chat_id"]
+    # In the send methods and in delete_message, chat_id is the first positional argument
+    if (name.startswith("send_") or name == "delete_message") and args:
+        return args[0]
+    return None
+
+
+def dump_metrics(metrics: Metrics, file: str):
+    """Log the metrics of the calls to the Bot API and, if a file is specified, save them to it in JSON."""
+    log.info(f"Telegram API calls:\n{metrics.format()}")
+    if file:
+        with open(file, "w") as f:
+            json.dump(metrics.snapshot(), f, indent=2)
+
+
 def factory(cfg: nuconfig.NuConfig):
     """Construct a DuckBot type based on the passed config."""
 
+    # All the bots constructed by the factory share the same rate limits
+    rate_limiter = RateLimiter(cfg)
+    # All the bots constructed by the factory share the same pool of keep-alive connections to Telegram
+    request = telegram.utils.request.Request(con_pool_size=cfg["Telegram"]["connection_pool_size"])
+    # All the bots constructed by the factory retry the failed calls in the same way
+    retry_policy = RetryPolicy(cfg)
+    # All the bots constructed by the factory stop calling Telegram together when it's unreachable
+    circuit_breaker = CircuitBreaker(cfg)
+    # All the bots constructed by the factory share the queues of the outgoing calls of every chat
+    outbox = Outbox(threads=cfg["Telegram"]["outbound_threads"])
+    # All the bots constructed by the factory share the threads delivering the broadcasts
+    broadcaster = broadcast.Broadcaster(cfg)
+    # All the bots constructed by the factory record their calls in the same metrics
+    metrics = Metrics()
+    if cfg["Telegram"]["Metrics"]["dump_on_exit"]:
+        atexit.register(dump_metrics, metrics, cfg["Telegram"]["Metrics"]["file"])
+
+    def measured(func):
+        """Decorator, can be applied to any bot method to record the latency and the errors of its calls."""
+
+        def result_func(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = func(self, *args, **kwargs)
+            except Exception as error:
+                metrics.observe(func.__name__, time.perf_counter() - start, error)
+                raise
+            metrics.observe(func.__name__, time.perf_counter() - start)
+            return result
+
+        result_func.__name__ = func.__name__
+        return result_func
+
+    def rate_limited(func):
+        """Decorator, can be applied to the methods sending messages to wait until the rate limits allow it."""
+
+        def result_func(self, *args, **kwargs):
+            # The edits don't add messages to the chat, so they aren't limited like the new messages
+            rate_limiter.acquire(get_chat_id(func.__name__, args, kwargs),
+                                 per_chat=func.__name__.startswith("send_"))
+            return func(self, *args, **kwargs)
+
+        result_func.__name__ = func.__name__
+        result_func.rate_limited = True
+        return result_func
+
+    def submit(self, func, args, kwargs) -> concurrent.futures.Future:
+        """Submit a call of a bot method to the Outbox, in the queue of its chat."""
+        return outbox.submit(get_chat_id(func.__name__, args, kwargs),
+                             func.__name__,
+                             functools.partial(func, self, *args, **kwargs),
+                             message_id=get_message_id(func.__name__, args, kwargs))
+
+    def queued(func):
+        """Decorator, can be applied to the methods bound to a chat to make them through the Outbox, if enabled.
+        The edits return a future of their result instead of waiting for it, so that a following edit can replace
+        them while they are still queued.
+        If the Outbox is disabled the calls are made in the calling thread, but still after the calls made in the
+        background in the same chat."""
+
+        def result_func(self, *args, **kwargs):
+            if not cfg["Telegram"]["outbound_queue"]:
+                return outbox.call(get_chat_id(func.__name__, args, kwargs),
+                                   func.__name__,
+                                   functools.partial(func, self, *args, **kwargs),
+                                   message_id=get_message_id(func.__name__, args, kwargs))
+            future = submit(self, func, args, kwargs)
+            if func.__name__ in Outbox.COALESCED:
+                future.add_done_callback(log_call_failure)
+                return future
+            return future.result()
+
+        result_func.__name__ = func.__name__
+        return result_func
+
+    def in_background(func):
+        """Decorator, can be applied to the methods whose result is never used to make them through the Outbox
+        without waiting for them, even if the outbound queue is disabled.
+        They return a future of their result; their failures are logged."""
+
+        def result_func(self, *args, **kwargs):
+            future = submit(self, func, args, kwargs)
+            future.add_done_callback(log_call_failure)
+            return future
+
+        result_func.__name__ = func.__name__
+        return result_func
+
     def catch_telegram_errors(func):
-        """Decorator, can be applied to any function to retry in case of Telegram errors."""
+        """Decorator, can be applied to any function to retry in case of Telegram errors.
+        The errors are raised again when the retry budget of the function is exhausted.
+        A max_retries keyword argument overrides the budget of a single call, and makes the flood limits count against
+        it too: with max_retries=0 every error is raised at once, for the callers which reschedule the call themselves."""
 
-        def result_func(*args, **kwargs):
+        def exhausted(attempt: int, max_retries: Optional[int]) -> bool:
+            if max_retries is None:
+                return retry_policy.exhausted(func.__name__, attempt)
+            return attempt > max_retries
+
+        def result_func(*args, max_retries: Optional[int] = None, **kwargs):
+            # The number of consecutive failures of the call, not counting the flood limits
+            attempt = 0
             while True:
+                # Wait for Telegram to be reachable
+                circuit_breaker.before_call()
                 try:
-                    return func(*args, **kwargs)
+                    result = func(*args, **kwargs)
+                    circuit_breaker.success()
+                    return result
                 # Bot was blocked by the user
                 except telegram.error.Unauthorized:
+                    circuit_breaker.success()
                     log.debug(f"Unauthorized to call {func.__name__}(), skipping.")
                     break
+                # Flood limit exceeded
+                except telegram.error.RetryAfter as error:
+                    circuit_breaker.success()
+                    chat_id = get_chat_id(func.__name__, args[1:], kwargs)
+                    rate_limiter.retry_after(chat_id, error.retry_after)
+                    if max_retries is not None:
+                        attempt += 1
+                        if attempt > max_retries:
+                            log.warning(f"Flood limit exceeded while calling {func.__name__}() for chat {chat_id},"
+                                        f" not retrying.")
+                            raise
+                    log.warning(f"Flood limit exceeded while calling {func.__name__}() for chat {chat_id},"
+                                f" retrying in {error.retry_after} secs...")
+                    # The rate limiter will wait for the chat to be unblocked, if the method is rate limited
+                    metrics.retry(func.__name__)
+                    if not getattr(func, "rate_limited", False):
+                        time.sleep(error.retry_after)
+                    continue
+                # The chat is flooding the bot: the message wasn't sent, and retrying it would wait again
+                except RateLimitExceeded as error:
+                    circuit_breaker.abort()
+                    log.warning(f"Not calling {func.__name__}(): {error.message}")
+                    raise
+                # The request is invalid, and retrying it would fail in the same way
+                except telegram.error.BadRequest as error:
+                    circuit_breaker.success()
+                    log.error(f"Bad request while calling {func.__name__}(), not retrying.\n"
+                              f"Full error: {error.message}")
+                    raise
                 # Telegram API didn't answer in time
                 except telegram.error.TimedOut:
+                    circuit_breaker.failure()
+                    attempt += 1
+                    if exhausted(attempt, max_retries):
+                        log.error(f"Timed out while calling {func.__name__}(), giving up after {attempt} attempts.")
+                        raise
+                    delay = retry_policy.delay(cfg["Telegram"]["timed_out_pause"], attempt)
                     log.warning(f"Timed out while calling {func.__name__}(),"
-                                f" retrying in {cfg['Telegram']['timed_out_pause']} secs...")
-                    time.sleep(cfg["Telegram"]["timed_out_pause"])
+                                f" retrying in {delay:.1f} secs...")
                 # Telegram is not reachable
                 except telegram.error.NetworkError as error:
+                    circuit_breaker.failure()
+                    attempt += 1
+                    if exhausted(attempt, max_retries):
+                        log.error(f"Network error while calling {func.__name__}(),"
+                                  f" giving up after {attempt} attempts.\n"
+                                  f"Full error: {error.message}")
+                        raise
+                    delay = retry_policy.delay(cfg["Telegram"]["error_pause"], attempt)
                     log.error(f"Network error while calling {func.__name__}(),"
-                              f" retrying in {cfg['Telegram']['error_pause']} secs...\n"
+                              f" retrying in {delay:.1f} secs...\n"
                               f"Full error: {error.message}")
-                    time.sleep(cfg["Telegram"]["error_pause"])
                 # Unknown error
                 except telegram.error.TelegramError as error:
+                    circuit_breaker.success()
+                    attempt += 1
+                    if exhausted(attempt, max_retries):
+                        log.error(f"Telegram error while calling {func.__name__}(),"
+                                  f" giving up after {attempt} attempts.\n"
+                                  f"Full error: {error.message}")
+                        raise
                     if error.message.lower() in ["bad gateway", "invalid server response"]:
+                        delay = retry_policy.delay(cfg["Telegram"]["error_pause"], attempt)
                         log.warning(f"Bad Gateway while calling {func.__name__}(),"
-                                    f" retrying in {cfg['Telegram']['error_pause']} secs...")
-                        time.sleep(cfg["Telegram"]["error_pause"])
+                                    f" retrying in {delay:.1f} secs...")
                     elif error.message.lower() == "timed out":
+                        delay = retry_policy.delay(cfg["Telegram"]["timed_out_pause"], attempt)
                         log.warning(f"Timed out while calling {func.__name__}(),"
-                                    f" retrying in {cfg['Telegram']['timed_out_pause']} secs...")
-                        time.sleep(cfg["Telegram"]["timed_out_pause"])
+                                    f" retrying in {delay:.1f} secs...")
                     else:
+                        delay = retry_policy.delay(cfg["Telegram"]["error_pause"], attempt)
                         log.error(f"Telegram error while calling {func.__name__}(),"
-                                  f" retrying in {cfg['Telegram']['error_pause']} secs...\n"
+                                  f" retrying in {delay:.1f} secs...\n"
                                   f"Full error: {error.message}")
                         traceback.print_exception(*sys.exc_info())
-                        time.sleep(cfg["Telegram"]["error_pause"])
+                # Not an error of Telegram
+                except Exception:
+                    circuit_breaker.abort()
+                    raise
+                metrics.retry(func.__name__)
+                time.sleep(delay)
 
+        result_func.__name__ = func.__name__
         return result_func
 
     class DuckBot:
         def __init__(self, *args, **kwargs):
-            self.bot = telegram.Bot(token=cfg["Telegram"]["token"], *args, **kwargs)
+            self.bot = telegram.Bot(token=cfg["Telegram"]["token"],
+                                    base_url=f"{cfg['Telegram']['api_url']}/bot",
+                                    base_file_url=f"{cfg['Telegram']['api_url']}/file/bot",
+                                    request=request,
+                                    *args, **kwargs)
+            # The state of the connection to Telegram, shared by all the bots
+            self.circuit_breaker: CircuitBreaker = circuit_breaker
+            # The metrics of the calls to Telegram, shared by all the bots
+            self.metrics: Metrics = metrics
+
+        def broadcast(self, recipients: Iterable, calls: List[broadcast.BroadcastCall]) -> concurrent.futures.Future:
+            """Make the calls for every recipient in the background, and return a future of the BroadcastReport."""
+            return broadcaster.broadcast(self, recipients, calls)
 
+        @queued
         @catch_telegram_errors
+        @rate_limited
+        @measured
         def send_message(self, *args, **kwargs):
             # All messages are sent in HTML parse mode
             return self.bot.send_message(parse_mode="HTML", *args, **kwargs)
 
+        @queued
         @catch_telegram_errors
+        @rate_limited
+        @measured
         def edit_message_text(self, *args, **kwargs):
             # All messages are sent in HTML parse mode
             return self.bot.edit_message_text(parse_mode="HTML", *args, **kwargs)
 
+        @queued
         @catch_telegram_errors
+        @rate_limited
+        @measured
         def edit_message_caption(self, *args, **kwargs):
             # All messages are sent in HTML parse mode
             return self.bot.edit_message_caption(parse_mode="HTML", *args, **kwargs)
 
+        @queued
         @catch_telegram_errors
+        @rate_limited
+        @measured
         def edit_message_reply_markup(self, *args, **kwargs):
             return self.bot.edit_message_reply_markup(*args, **kwargs)
 
         @catch_telegram_errors
+        @measured
         def get_updates(self, *args, **kwargs):
             return self.bot.get_updates(*args, **kwargs)
 
         @catch_telegram_errors
+        @measured
+        def set_webhook(self, *args, **kwargs):
+            return self.bot.set_webhook(*args, **kwargs)
+
+        @catch_telegram_errors
+        @measured
+        def delete_webhook(self, *args, **kwargs):
+            return self.bot.delete_webhook(*args, **kwargs)
+
+        @catch_telegram_errors
+        @measured
         def get_me(self, *args, **kwargs):
             return self.bot.get_me(*args, **kwargs)
 
+        @in_background
         @catch_telegram_errors
+        @measured
         def answer_callback_query(self, *args, **kwargs):
             return self.bot.answer_callback_query(*args, **kwargs)
 
         @catch_telegram_errors
+        @measured
         def answer_pre_checkout_query(self, *args, **kwargs):
             return self.bot.answer_pre_checkout_query(*args, **kwargs)
 
+        @queued
         @catch_telegram_errors
+        @rate_limited
+        @measured
         def send_invoice(self, *args, **kwargs):
             return self.bot.send_invoice(*args, **kwargs)
 
         @catch_telegram_errors
+        @measured
         def get_file(self, *args, **kwargs):
             return self.bot.get_file(*args, **kwargs)
 
+        @in_background
         @catch_telegram_errors
+        @measured
         def send_chat_action(self, *args, **kwargs):
             return self.bot.send_chat_action(*args, **kwargs)
 
+        @in_background
         @catch_telegram_errors
+        @measured
         def delete_message(self, *args, **kwargs):
             return self.bot.delete_message(*args, **kwargs)
 
+        @queued
         @catch_telegram_errors
+        @rate_limited
+        @measured
         def send_document(self, *args, **kwargs):
             return self.bot.send_document(*args, **kwargs)
 
+        @queued
         @catch_telegram_errors
+        @rate_limited
+        @measured
         def send_location(self, *args, **kwargs):
             return self.bot.send_location(*args, **kwargs)
 
+        @queued
+        @catch_telegram_errors
+        @rate_limited
+        @measured
+        def send_photo(self, *args, **kwargs):
+            # All captions are sent in HTML parse mode
+            return self.bot.send_photo(parse_mode="HTML", *args, **kwargs)
+
         # More methods can be added here
 
     return DuckBot
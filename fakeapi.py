@@ -0,0 +1,467 @@
+"""A fake Telegram Bot API running in process, to test and benchmark the bot without a token or a network.
+
+It answers the same HTTP calls the bot makes to api.telegram.org, keeps the messages of every chat in memory, and
+delivers through getUpdates the updates sent by simulated users. Latency and errors can be injected in its answers.
+
+Run it with simulated users browsing the bot at random, then start the bot with api_url = "http://127.0.0.1:8081":
+    python -m fakeapi --port 8081 --users 50 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import email.parser
+import email.policy
+import http.server
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+from typing import *
+
+log = logging.getLogger(__name__)
+
+
+class FakeAPIError(Exception):
+    """An error answered by the fake API, in the same format Telegram uses."""
+
+    def __init__(self, status: int, description: str, retry_after: Optional[int] = None):
+        super().__init__(description)
+        self.status: int = status
+        self.description: str = description
+        self.retry_after: Optional[int] = retry_after
+
+    def to_dict(self) -> dict:
+        result = {"ok": False, "error_code": self.status, "description": self.description}
+        if self.retry_after is not None:
+            result["parameters"] = {"retry_after": self.retry_after}
+        return result
+
+
+class FakeBotAPI:
+    """An in-process HTTP server imitating the Telegram Bot API.
+    latency seconds, plus or minus jitter, are waited before answering every call but getUpdates; error_rate is the
+    fraction of those calls which fail with one of the injected errors, chosen at random."""
+
+    # The errors which can be injected, as they are answered by Telegram
+    ERRORS = {
+        "bad_gateway": lambda: FakeAPIError(502, "Bad Gateway"),
+        "flood": lambda: FakeAPIError(429, "Too Many Requests: retry after 1", retry_after=1),
+        "internal": lambda: FakeAPIError(500, "Internal Server Error"),
+    }
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, token: Optional[str] = None,
+                 latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 errors: Iterable[str] = ("bad_gateway", "flood")):
+        # If None, any token is accepted
+        self.token: Optional[str] = token
+        self.latency: float = latency
+        self.jitter: float = jitter
+        self.error_rate: float = error_rate
+        self.errors: List[str] = list(errors)
+        self.me = {"id": 1, "is_bot": True, "first_name": "Fake bot", "username": "fake_bot"}
+        # The messages of every chat which haven't been deleted, by message id
+        self.chats: Dict[Union[int, str], Dict[int, dict]] = {}
+        self.message_ids: Dict[Union[int, str], Iterator[int]] = {}
+        # The numeric ids of the channels specified by their username
+        self.channel_ids: Dict[str, int] = {}
+        # The updates not yet confirmed by the bot
+        self.updates: List[dict] = []
+        self.update_ids = itertools.count(1)
+        # The files uploaded to the API, by file id
+        self.files: Dict[str, bytes] = {}
+        self.file_ids = itertools.count(1)
+        self.callback_ids = itertools.count(1)
+        # The number of calls received, by method
+        self.calls: Dict[str, int] = {}
+        # Guards all the state above, and is notified when a new update is available
+        self.condition = threading.Condition()
+        self.server = http.server.ThreadingHTTPServer((host, port), self.__handler_factory())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="Fake API", daemon=True)
+
+    @property
+    def url(self) -> str:
+        """The url to configure as api_url for the bot to use this API."""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        log.debug(f"Starting the fake Bot API on {self.url}")
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __handler_factory(self):
+        """Create the request handler class, bound to this API."""
+        api = self
+
+        class FakeAPIRequestHandler(http.server.BaseHTTPRequestHandler):
+            # Keep the connections alive, like Telegram does
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                try:
+                    method = api.parse_path(self.path, "/bot")
+                    params = api.parse_params(self.headers.get("Content-Type", ""), body)
+                    result = {"ok": True, "result": api.call(method, params)}
+                    status = 200
+                except FakeAPIError as error:
+                    result = error.to_dict()
+                    status = error.status
+                self.answer(status, json.dumps(result).encode("utf-8"), "application/json")
+
+            def do_GET(self):
+                try:
+                    file_path = api.parse_path(self.path, "/file/bot")
+                    data = api.files[file_path.rsplit("/", 1)[-1]]
+                except (FakeAPIError, KeyError):
+                    self.answer(404, b"Not Found", "text/plain")
+                    return
+                self.answer(200, data, "application/octet-stream")
+
+            def answer(self, status: int, body: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(f"{self.client_address[0]} - {format % args}")
+
+        return FakeAPIRequestHandler
+
+    def parse_path(self, path: str, prefix: str) -> str:
+        """Check the token in a request path, and return what follows it."""
+        if not path.startswith(prefix):
+            raise FakeAPIError(404, "Not Found")
+        token, _, rest = path[len(prefix):].partition("/")
+        if self.token is not None and token != self.token:
+            raise FakeAPIError(401, "Unauthorized")
+        return rest
+
+    @staticmethod
+    def parse_params(content_type: str, body: bytes) -> Dict[str, Any]:
+        """Parse the parameters of a call, sent either in JSON or, if there are files, as multipart form data."""
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if content_type.startswith("multipart/form-data"):
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            params = {}
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                payload = part.get_payload(decode=True)
+                # The files are kept as bytes, everything else is text
+                params[name] = payload if part.get_filename() else payload.decode("utf-8")
+            return params
+        return {key: values[0] for key, values in urllib.parse.parse_qs(body.decode("utf-8")).items()}
+
+    def call(self, method: str, params: Dict[str, Any]) -> Any:
+        """Perform a call of the API, and return its result."""
+        with self.condition:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        handler = getattr(self, f"_{method}", None)
+        if handler is None:
+            raise FakeAPIError(404, "Not Found: method not found")
+        # Long polling mustn't be slowed down or fail, or the bot would stop receiving updates
+        if method != "getUpdates":
+            self.__inject()
+        return handler(params)
+
+    def __inject(self):
+        """Wait the configured latency, and raise one of the injected errors if it's due."""
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.errors and random.random() < self.error_rate:
+            raise self.ERRORS[random.choice(self.errors)]()
+
+    @staticmethod
+    def chat_key(chat_id) -> Union[int, str]:
+        """Normalize a chat id, which the bot may send as a string or as the @username of a channel."""
+        try:
+            return int(chat_id)
+        except ValueError:
+            if not str(chat_id).startswith("@"):
+                raise FakeAPIError(400, "Bad Request: chat not found")
+            return chat_id
+
+    def chat(self, chat_id: Union[int, str]) -> dict:
+        """Describe a chat, giving the channels specified by their username a numeric id like Telegram does."""
+        if isinstance(chat_id, str):
+            channel_id = self.channel_ids.setdefault(chat_id, -1000000000000 - len(self.channel_ids) - 1)
+            return {"id": channel_id, "type": "channel", "title": chat_id, "username": chat_id[1:]}
+        return {"id": chat_id, "type": "private" if chat_id > 0 else "group"}
+
+    def add_message(self, chat_id, message: dict) -> dict:
+        """Store a new message in a chat, assigning it the next message id of the chat."""
+        chat_id = self.chat_key(chat_id)
+        with self.condition:
+            message_ids = self.message_ids.setdefault(chat_id, itertools.count(1))
+            message["message_id"] = next(message_ids)
+            message.setdefault("date", int(time.time()))
+            message.setdefault("chat", self.chat(chat_id))
+            self.chats.setdefault(chat_id, {})[message["message_id"]] = message
+        return message
+
+    def get_message(self, chat_id, message_id, action: str = "edit") -> dict:
+        try:
+            return self.chats[self.chat_key(chat_id)][int(message_id)]
+        except KeyError:
+            raise FakeAPIError(400, f"Bad Request: message to {action} not found")
+
+    def messages(self, chat_id) -> List[dict]:
+        """Get the messages of a chat which haven't been deleted, oldest first."""
+        with self.condition:
+            return list(self.chats.get(self.chat_key(chat_id), {}).values())
+
+    def add_update(self, update: dict) -> dict:
+        """Queue an update for the bot, assigning it the next update id."""
+        with self.condition:
+            update["update_id"] = next(self.update_ids)
+            self.updates.append(update)
+            self.condition.notify_all()
+        return update
+
+    def add_file(self, data: bytes) -> Dict[str, Any]:
+        """Store a file, and return its description."""
+        with self.condition:
+            file_id = f"file{next(self.file_ids)}"
+            self.files[file_id] = data
+        return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(data)}
+
+    def __send(self, params: Dict[str, Any], **content) -> dict:
+        """Store a message sent by the bot."""
+        message = {"from": self.me, **content}
+        self.__set_markup(message, params.get("reply_markup"))
+        return self.add_message(params["chat_id"], message)
+
+    @staticmethod
+    def __set_markup(message: dict, markup):
+        """Set the keyboard of a message.
+        Like Telegram, the messages only include the inline keyboards; the other keyboards are kept in reply_keyboard,
+        a field which isn't part of the API, for the simulated users to see them."""
+        markup = json.loads(markup) if isinstance(markup, str) else (markup or {})
+        message.pop("reply_markup", None)
+        message.pop("reply_keyboard", None)
+        if "inline_keyboard" in markup:
+            message["reply_markup"] = markup
+        elif "keyboard" in markup:
+            message["reply_keyboard"] = markup
+
+    def __photo(self, photo) -> List[dict]:
+        """Get the sizes of a sent photo, storing it if it has been uploaded."""
+        if isinstance(photo, bytes):
+            description = self.add_file(photo)
+        else:
+            description = {"file_id": photo, "file_unique_id": photo}
+        return [{**description, "width": 800, "height": 800}]
+
+    # The methods of the API
+
+    def _getMe(self, params):
+        return self.me
+
+    def _getUpdates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        with self.condition:
+            # Forget the updates confirmed by the offset
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            self.condition.wait_for(lambda: self.updates, timeout=timeout)
+            return self.updates[:limit]
+
+    def _setWebhook(self, params):
+        return True
+
+    def _deleteWebhook(self, params):
+        return True
+
+    def _sendMessage(self, params):
+        return self.__send(params, text=params["text"])
+
+    def _sendPhoto(self, params):
+        return self.__send(params, photo=self.__photo(params["photo"]), caption=params.get("caption", ""))
+
+    def _sendDocument(self, params):
+        document = params["document"]
+        description = self.add_file(document) if isinstance(document, bytes) else {"file_id": document,
+                                                                                   "file_unique_id": document}
+        return self.__send(params, document=description, caption=params.get("caption", ""))
+
+    def _sendLocation(self, params):
+        return self.__send(params, location={"latitude": float(params["latitude"]),
+                                             "longitude": float(params["longitude"])})
+
+    def _sendInvoice(self, params):
+        prices = params["prices"]
+        prices = json.loads(prices) if isinstance(prices, str) else prices
+        return self.__send(params, invoice={"title": params["title"],
+                                            "description": params["description"],
+                                            "start_parameter": params.get("start_parameter", ""),
+                                            "currency": params["currency"],
+                                            "total_amount": sum(int(price["amount"]) for price in prices)})
+
+    def _editMessageText(self, params):
+        with self.condition:
+            message = self.get_message(params["chat_id"], params["message_id"])
+            message["text"] = params["text"]
+            self.__set_markup(message, params.get("reply_markup"))
+            return message
+
+    def _editMessageCaption(self, params):
+        with self.condition:
+            message = self.get_message(params["chat_id"], params["message_id"])
+            message["caption"] = params.get("caption", "")
+            self.__set_markup(message, params.get("reply_markup"))
+            return message
+
+    def _editMessageReplyMarkup(self, params):
+        with self.condition:
+            message = self.get_message(params["chat_id"], params["message_id"])
+            self.__set_markup(message, params.get("reply_markup"))
+            return message
+
+    def _deleteMessage(self, params):
+        with self.condition:
+            message = self.get_message(params["chat_id"], params["message_id"], action="delete")
+            del self.chats[self.chat_key(params["chat_id"])][message["message_id"]]
+        return True
+
+    def _sendChatAction(self, params):
+        return True
+
+    def _answerCallbackQuery(self, params):
+        return True
+
+    def _answerPreCheckoutQuery(self, params):
+        return True
+
+    def _getFile(self, params):
+        if params["file_id"] not in self.files:
+            raise FakeAPIError(400, "Bad Request: invalid file_id")
+        return {"file_id": params["file_id"],
+                "file_unique_id": params["file_id"],
+                "file_size": len(self.files[params["file_id"]]),
+                "file_path": f"photos/{params['file_id']}"}
+
+
+class SimulatedUser:
+    """A user chatting with the bot through a FakeBotAPI."""
+
+    def __init__(self, api: FakeBotAPI, user_id: int, first_name: str = "User", language_code: str = "en"):
+        self.api: FakeBotAPI = api
+        self.user = {"id": user_id, "is_bot": False, "first_name": first_name, "language_code": language_code}
+        self.chat = {"id": user_id, "type": "private", "first_name": first_name}
+
+    @property
+    def id(self) -> int:
+        return self.user["id"]
+
+    def __send(self, **content) -> dict:
+        """Send a message to the bot."""
+        message = self.api.add_message(self.id, {"from": self.user, "chat": self.chat, **content})
+        return self.api.add_update({"message": message})
+
+    def send_text(self, text: str) -> dict:
+        return self.__send(text=text)
+
+    def send_location(self, latitude: float, longitude: float) -> dict:
+        return self.__send(location={"latitude": latitude, "longitude": longitude})
+
+    def send_contact(self, phone_number: str) -> dict:
+        return self.__send(contact={"phone_number": phone_number,
+                                    "first_name": self.user["first_name"],
+                                    "user_id": self.id})
+
+    def send_photo(self, data: bytes) -> dict:
+        description = self.api.add_file(data)
+        return self.__send(photo=[{**description, "width": 800, "height": 800}])
+
+    def press(self, message: dict, callback_data: str) -> dict:
+        """Press a button of an inline keyboard."""
+        return self.api.add_update({"callback_query": {"id": str(next(self.api.callback_ids)),
+                                                       "from": self.user,
+                                                       "message": message,
+                                                       "chat_instance": str(self.id),
+                                                       "data": callback_data}})
+
+    def messages(self) -> List[dict]:
+        """Get the messages of the chat which haven't been deleted, oldest first."""
+        return self.api.messages(self.id)
+
+    def last_bot_message(self) -> Optional[dict]:
+        """Get the last message sent by the bot in the chat."""
+        for message in reversed(self.messages()):
+            if message["from"]["is_bot"]:
+                return message
+        return None
+
+    def step(self):
+        """Do something at random with the last message sent by the bot: press one of its buttons, or answer it."""
+        message = self.last_bot_message()
+        if message is None:
+            self.send_text("/start")
+            return
+        markup = message.get("reply_markup") or message.get("reply_keyboard") or {}
+        inline_buttons = [button for row in markup.get("inline_keyboard", []) for button in row
+                          if "callback_data" in button]
+        buttons = [button for row in markup.get("keyboard", []) for button in row]
+        if inline_buttons:
+            self.press(message, random.choice(inline_buttons)["callback_data"])
+        elif buttons:
+            button = random.choice(buttons)
+            button = {"text": button} if isinstance(button, str) else button
+            if button.get("request_location"):
+                self.send_location(41.3, 69.2)
+            elif button.get("request_contact"):
+                self.send_contact(f"+998{self.id:09d}"[-12:])
+            else:
+                self.send_text(button["text"])
+        else:
+            self.send_text(random.choice(["/start", "Hello", "1"]))
+
+
+def simulate(api: FakeBotAPI, users: int, think_time: float, duration: Optional[float] = None):
+    """Make the specified number of simulated users act at random, every think_time seconds on average."""
+    simulated = [SimulatedUser(api, 10000 + number, first_name=f"User {number}") for number in range(users)]
+    end = time.monotonic() + duration if duration is not None else None
+    while end is None or time.monotonic() < end:
+        random.choice(simulated).step()
+        time.sleep(random.expovariate(users / think_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8081, help="port to listen on")
+    parser.add_argument("--token", help="the only bot token accepted; if omitted, any token is")
+    parser.add_argument("--users", type=int, default=10, help="number of simulated users")
+    parser.add_argument("--think-time", type=float, default=5, help="average seconds between the actions of a user")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before answering a call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximum random variation of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of the calls failing")
+    parser.add_argument("--errors", default="bad_gateway,flood",
+                        help=f"comma-separated errors to inject, among {', '.join(FakeBotAPI.ERRORS)}")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    api = FakeBotAPI(host=args.host, port=args.port, token=args.token, latency=args.latency, jitter=args.jitter,
+                     error_rate=args.error_rate, errors=args.errors.split(","))
+    api.start()
+    log.info(f"Fake Bot API listening on {api.url}, simulating {args.users} users")
+    try:
+        simulate(api, users=args.users, think_time=args.think_time)
+    except KeyboardInterrupt:
+        log.info(f"Calls received: {api.calls}")
+        api.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""The stores of the product images.
+
+By default the images are stored in the image column of the products table; with the filesystem store, they are
+written once in files named after the hash of their content, and only the hash is kept in the database.
+
+Move the images from the database to the configured store with:
+    python -m imagestore migrate
+"""
+import abc
+import argparse
+import contextlib
+import hashlib
+import io
+import logging
+import mmap
+import os
+import tempfile
+from typing import *
+
+import nuconfig
+
+log = logging.getLogger(__name__)
+
+
+class ImageStore(abc.ABC):
+    """A store of images, addressed by the hash of their content."""
+
+    @staticmethod
+    def hash(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    @abc.abstractmethod
+    def put(self, data: bytes) -> str:
+        """Store an image, if it isn't stored already, and return its hash."""
+
+    @abc.abstractmethod
+    def open(self, image_hash: str) -> ContextManager[BinaryIO]:
+        """Open a stored image, as a context manager of a buffer supporting the file interface, which is released
+        when the context is exited."""
+
+    @abc.abstractmethod
+    def __contains__(self, image_hash: str) -> bool:
+        """Check if an image is stored."""
+
+
+class FileSystemImageStore(ImageStore):
+    """Store the images in a directory, in files named after the hash of their content.
+    The files are read through read-only memory maps, so that the content is paged in by the OS and shared between
+    all the threads and processes sending the same image, instead of being copied in every one of them."""
+
+    def __init__(self, path: str):
+        self.path: str = path
+        os.makedirs(path, exist_ok=True)
+
+    def file_path(self, image_hash: str) -> str:
+        # Split the files in subdirectories, so that no directory grows too much
+        return os.path.join(self.path, image_hash[:2], image_hash)
+
+    def put(self, data: bytes) -> str:
+        image_hash = self.hash(data)
+        path = self.file_path(image_hash)
+        # The same content is always stored in the same file, so it never has to be written again
+        if os.path.exists(path):
+            return image_hash
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename it, so that a file with its final name is always complete
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(data)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+        return image_hash
+
+    @contextlib.contextmanager
+    def open(self, image_hash: str) -> Iterator[BinaryIO]:
+        with open(self.file_path(image_hash), "rb") as file:
+            # Empty files can't be mapped
+            if os.fstat(file.fileno()).st_size == 0:
+                yield io.BytesIO()
+                return
+            # Unmap the file as soon as the caller is done with it
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                yield content
+
+    def __contains__(self, image_hash: str) -> bool:
+        return os.path.exists(self.file_path(image_hash))
+
+
+# The store of the images of this process, or None if they are stored in the database
+store: Optional[ImageStore] = None
+
+
+def configure(cfg: nuconfig.NuConfig):
+    """Create the image store specified in the config."""
+    global store
+    if cfg["Images"]["store"] == "filesystem":
+        store = FileSystemImageStore(cfg["Images"]["path"])
+    else:
+        store = None
+
+
+def migrate(cfg: nuconfig.NuConfig, batch_size: int = 50):
+    """Move the images stored in the database to the configured store."""
+    # Imported here, as the database module uses this one
+    import sqlalchemy.orm
+
+    import core
+    import database as db
+
+    if store is None:
+        log.fatal("The images are configured to be stored in the database, there is nothing to migrate.")
+        return
+    engine = core.create_engine(cfg)
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    moved = 0
+    while True:
+        # Load a batch at a time, so that all the images are never in memory together
+        products = session.query(db.Product) \
+            .filter(db.Product.image.isnot(None)) \
+            .options(sqlalchemy.orm.undefer(db.Product.image)) \
+            .limit(batch_size) \
+            .all()
+        if not products:
+            break
+        for product in products:
+            product.image_hash = store.put(product.image)
+            product.image = None
+        session.commit()
+        # Free the images of the batch
+        session.expunge_all()
+        moved += len(products)
+        log.info(f"Moved {moved} images")
+    log.info(f"Migration complete, {moved} images moved to the image store")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["migrate"], help="migrate: move the images from the database to the store")
+    parser.add_argument("--config", default="config/config.toml", help="the config of the bot")
+    args = parser.parse_args()
+
+    with open(args.config, encoding="utf8") as cfg_file:
+        cfg = nuconfig.NuConfig(cfg_file)
+    import core
+    core.setup_logging(cfg)
+    configure(cfg)
+    if args.command == "migrate":
+        migrate(cfg)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import concurrent.futures
+import io
+import logging
+from typing import *
+
+import nuconfig
+
+try:
+    import PIL.Image
+    import PIL.ImageOps
+except ImportError:
+    PIL = None
+
+log = logging.getLogger(__name__)
+
+
+class ProcessedImage:
+    """An image ready to be stored: its normalised data, and its thumbnail if it could be made."""
+
+    def __init__(self, data: bytes, thumbnail: Optional[bytes] = None):
+        self.data: bytes = data
+        self.thumbnail: Optional[bytes] = thumbnail
+
+    def __repr__(self):
+        return f"<ProcessedImage of {len(self.data)} bytes>"
+
+
+class ImagePipeline:
+    """Normalise the images of the products before they are stored, in its own threads.
+    The images are decoded, rotated as their metadata says, stripped of the metadata, shrunk to fit max_size and
+    re-encoded as JPEG at the configured quality, with a thumbnail fitting thumbnail_size.
+    Without Pillow, the images are stored as they are received."""
+
+    def __init__(self, cfg: nuconfig.NuConfig):
+        settings = cfg["Images"]
+        self.max_size: int = settings["max_size"]
+        self.quality: int = settings["quality"]
+        self.thumbnail_size: int = settings["thumbnail_size"]
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings["threads"],
+                                                              thread_name_prefix="Images")
+        if PIL is None:
+            log.warning("Pillow is not installed, the product images will be stored without being normalised")
+
+    def submit(self, func, *args, **kwargs) -> concurrent.futures.Future:
+        """Run a function in one of the threads of the pipeline."""
+        return self.executor.submit(func, *args, **kwargs)
+
+    def normalise(self, data: bytes) -> ProcessedImage:
+        """Normalise an image; if it can't be decoded, it's kept as it is."""
+        if PIL is None:
+            return ProcessedImage(data)
+        try:
+            with PIL.Image.open(io.BytesIO(data)) as image:
+                # The orientation is in the metadata, which is dropped
+                image = PIL.ImageOps.exif_transpose(image)
+                image = self.__flatten(image)
+                # Only ever shrink the image, keeping its aspect ratio
+                image.thumbnail((self.max_size, self.max_size), PIL.Image.LANCZOS)
+                normalised = self.__encode(image)
+                image.thumbnail((self.thumbnail_size, self.thumbnail_size), PIL.Image.LANCZOS)
+                thumbnail = self.__encode(image)
+        except (OSError, ValueError, PIL.Image.DecompressionBombError) as error:
+            log.warning(f"Couldn't normalise an image, storing it as it is: {error!r}")
+            return ProcessedImage(data)
+        log.debug(f"Normalised an image from {len(data)} to {len(normalised)} bytes")
+        return ProcessedImage(normalised, thumbnail)
+
+    @staticmethod
+    def __flatten(image: "PIL.Image.Image") -> "PIL.Image.Image":
+        """Convert an image to RGB, as required by JPEG, painting its transparent parts white."""
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image = image.convert("RGBA")
+            background = PIL.Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            return background
+        return image.convert("RGB")
+
+    def __encode(self, image: "PIL.Image.Image") -> bytes:
+        """Encode an image as JPEG; no metadata is written, as none is passed."""
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=self.quality, optimize=True, progressive=True)
+        return output.getvalue()
+
+
+# The image pipeline of this process
+pipeline: Optional[ImagePipeline] = None
+
+
+def configure(cfg: nuconfig.NuConfig):
+    """Create the image pipeline with the settings of the config."""
+    global pipeline
+    pipeline = ImagePipeline(cfg)
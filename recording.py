@@ -0,0 +1,155 @@
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from typing import *
+
+import telegram
+
+log = logging.getLogger(__name__)
+
+# The fields of the users and chats which could identify a person, and what they are replaced with
+PERSONAL_FIELDS = {
+    "first_name": "User",
+    "last_name": None,
+    "username": None,
+    "title": "Chat",
+    "phone_number": "+10000000000",
+    "vcard": None,
+}
+
+
+def load_key(path: str, salt: str) -> bytes:
+    """Get the key of the placeholders of a log: the configured salt or, if there is none, a random key kept in a
+    file next to the log, created the first time."""
+    if salt:
+        return salt.encode()
+    key_path = path + ".key"
+    if not os.path.exists(key_path):
+        # Only the owner of the log can read the key
+        descriptor = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(descriptor, "w") as file:
+            file.write(secrets.token_hex(32))
+        log.info(f"Created the key of the placeholders of the recorded ids in {key_path}")
+    with open(key_path) as file:
+        return file.read().strip().encode()
+
+
+def compact(data: Any) -> Any:
+    """Remove the empty lists and the false flags python-telegram-bot adds to the dicts of the updates, recursively;
+    they are restored when the updates are parsed again."""
+    if isinstance(data, list):
+        return [compact(item) for item in data]
+    if not isinstance(data, dict):
+        return data
+    # is_bot is required to parse a user
+    return {key: compact(value) for key, value in data.items()
+            if not (value == [] or (value is False and key != "is_bot"))}
+
+
+class Anonymiser:
+    """Replace the ids and the personal data of the users in the updates with placeholders.
+    Every id is replaced by a keyed hash of it, so that it gets the same placeholder in every run recording with the
+    same key and the conversations can still be told apart, while the real id can't be found without the key; the
+    texts sent by the users are kept, as the bot needs them to be replayed."""
+
+    def __init__(self, key: bytes):
+        self.key: bytes = key
+        # The placeholder of every id seen so far
+        self.ids: Dict[int, int] = {}
+
+    def anonymise_id(self, value: int) -> int:
+        if value not in self.ids:
+            digest = hmac.new(self.key, str(abs(value)).encode(), hashlib.sha256).digest()
+            # Use 48 bits, which fit in the ids Telegram uses, and are unlikely to collide
+            placeholder = int.from_bytes(digest[:6], "big") or 1
+            # Keep the sign, as negative ids belong to groups and channels
+            self.ids[value] = placeholder if value > 0 else -placeholder
+        return self.ids[value]
+
+    def anonymise(self, data: Any) -> Any:
+        """Anonymise the dict of an update, recursively."""
+        if isinstance(data, list):
+            return [self.anonymise(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+        result = {}
+        # Users and chats are the only objects with both an id and a type or is_bot field
+        is_person = "id" in data and ("is_bot" in data or "type" in data)
+        for key, value in data.items():
+            if (is_person and key == "id") or key == "user_id":
+                result[key] = self.anonymise_id(value)
+            elif key in PERSONAL_FIELDS:
+                if PERSONAL_FIELDS[key] is not None:
+                    result[key] = PERSONAL_FIELDS[key]
+            elif key == "location":
+                result[key] = {"latitude": 0.0, "longitude": 0.0}
+            else:
+                result[key] = self.anonymise(value)
+        return result
+
+
+class RecordingSource:
+    """Wrap a source of updates, recording the batches it returns to a gzipped log of JSON lines.
+    Every line is a batch: [unix time it was received at, [update, ...]]; the log is appended to, so it can span
+    multiple runs of the bot."""
+
+    def __init__(self, source, path: str, salt: str = ""):
+        self.source = source
+        self.path: str = path
+        self.anonymiser = Anonymiser(load_key(path, salt))
+        # The id the next recorded update should have: the updates fetched again are skipped
+        self.next_update: Optional[int] = None
+        self.file = gzip.open(path, "at", encoding="utf8")
+        # Complete the gzip stream when the bot stops; if it's killed, the log can still be loaded up to the last flush
+        atexit.register(self.file.close)
+        self.lock = threading.Lock()
+        log.info(f"Recording the received updates to {path}")
+
+    def get_updates(self, *args, **kwargs) -> List[telegram.Update]:
+        updates = self.source.get_updates(*args, **kwargs)
+        if updates:
+            self.record(updates)
+        return updates
+
+    def record(self, updates: List[telegram.Update]):
+        """Append a batch of updates to the log, skipping the ones already recorded."""
+        # The sources which ignore the offset, like the webhook, can return the updates out of order: they are all
+        # recorded, and deduplicated by the dispatcher when replayed
+        if getattr(self.source, "uses_offset", True):
+            with self.lock:
+                updates = [update for update in updates
+                           if self.next_update is None or update.update_id >= self.next_update]
+                if not updates:
+                    return
+                self.next_update = updates[-1].update_id + 1
+        batch = [round(time.time(), 3),
+                 [compact(self.anonymiser.anonymise(update.to_dict())) for update in updates]]
+        with self.lock:
+            self.file.write(json.dumps(batch, separators=(",", ":"), ensure_ascii=False) + "\n")
+            # Don't lose the recorded batches if the bot is killed
+            self.file.flush()
+
+    def __getattr__(self, item):
+        # Behave like the wrapped source for everything else, like starting the webhook server
+        return getattr(self.source, item)
+
+
+def load(path: str) -> List[Tuple[float, List[dict]]]:
+    """Load the batches of updates recorded in a log."""
+    batches = []
+    with gzip.open(path, "rt", encoding="utf8") as file:
+        try:
+            for line in file:
+                if line.strip():
+                    batches.append(tuple(json.loads(line)))
+        # The bot was killed while recording, and the last lines are incomplete
+        except (EOFError, ValueError):
+            log.warning(f"{path} is truncated, loaded the first {len(batches)} batches")
+    return batches
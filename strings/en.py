@@ -298,10 +298,15 @@ prop_create_transactions = "Manage transactions"
 # Edit admin: show on help message?
 prop_display_on_help = "Show to customer"
 
-# Thread has started downloading an image and might be unresponsive
+# The image is being downloaded in the background
 downloading_image = "I'm downloading your photo!\n" \
-                    "It might take a while... Please be patient!\n" \
-                    "I won't be able to answer you while I'm downloading."
+                    "It might take a while, but you can keep going: I'll tell you when it's ready."
+
+# The image of a product has been downloaded and stored
+success_image_stored = "🖼 The image of <b>{name}</b> is ready!"
+
+# The image of a product couldn't be downloaded or stored
+error_image_download = "⚠️ The image of <b>{name}</b> couldn't be downloaded. Please send it again."
 
 # Edit product: current value
 edit_current_value = "The current value is:\n" \
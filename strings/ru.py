@@ -397,10 +397,15 @@ prop_create_transactions = "Управлять транзакциями"
 # Edit admin: show on help message?
 prop_display_on_help = "Показывать покупателям"
 
-# Thread has started downloading an image and might be unresponsive
+# The image is being downloaded in the background
 downloading_image = "Я загружаю фото!\n" \
-                    "Это может занять некоторое время...!\n" \
-                    "Я не смогу отвечать, пока идет загрузка."
+                    "Это может занять некоторое время, но вы можете продолжать: я сообщу, когда оно будет готово."
+
+# The image of a product has been downloaded and stored
+success_image_stored = "🖼 Изображение <b>{name}</b> готово!"
+
+# The image of a product couldn't be downloaded or stored
+error_image_download = "⚠️ Не удалось загрузить изображение <b>{name}</b>. Пожалуйста, отправьте его ещё раз."
 
 # Edit product: current value
 edit_current_value = "Текущее значение:\n" \
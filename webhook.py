@@ -0,0 +1,109 @@
+import http.server
+import json
+import logging
+import queue as queuem
+import threading
+from typing import *
+
+import telegram
+
+import nuconfig
+
+log = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """An embedded HTTP server receiving the updates pushed by Telegram.
+    It can be used by the dispatcher in place of the bot, as it has a get_updates method returning the updates received
+    since the last call."""
+
+    # The updates are pushed by Telegram, and can arrive out of order, so the offset is ignored
+    uses_offset = False
+
+    def __init__(self, bot, cfg: nuconfig.NuConfig):
+        self.bot = bot
+        self.cfg = cfg
+        # The updates received by the server and not yet fetched by the dispatcher
+        self.queue = queuem.Queue()
+        # Create the HTTP server; each request is handled in its own thread
+        self.server = http.server.ThreadingHTTPServer((cfg["Telegram"]["Webhook"]["listen"],
+                                                       cfg["Telegram"]["Webhook"]["port"]),
+                                                      self.__handler_factory())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="Webhook", daemon=True)
+
+    def __handler_factory(self):
+        """Create the request handler class, bound to this server."""
+        webhook = self
+
+        class WebhookRequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                # Ensure the update has been posted to the webhook path
+                if self.path != webhook.cfg["Telegram"]["Webhook"]["path"]:
+                    self.send_error(404)
+                    return
+                # Ensure the update has been sent by Telegram, if a secret token is configured
+                secret_token = webhook.cfg["Telegram"]["Webhook"]["secret_token"]
+                if secret_token and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+                    log.warning(f"Received an update with an invalid secret token from {self.client_address[0]}")
+                    self.send_error(403)
+                    return
+                # Read and parse the update
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    # A negative length would read until the client closes the connection
+                    if length < 0:
+                        raise ValueError(f"the Content-Length is negative: {length}")
+                    data = json.loads(self.rfile.read(length))
+                    if not isinstance(data, dict):
+                        raise ValueError(f"the update is a {type(data).__name__}, not an object")
+                    update = telegram.Update.de_json(data, webhook.bot.bot)
+                except (ValueError, TypeError, KeyError, AttributeError) as error:
+                    log.warning(f"Received an invalid update: {error!r}")
+                    self.send_error(400)
+                    return
+                if update is None:
+                    log.warning("Received an empty update")
+                    self.send_error(400)
+                    return
+                # Hand the update over to the dispatcher
+                webhook.queue.put(update)
+                # Acknowledge the update, so that Telegram doesn't send it again
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                log.debug(f"{self.client_address[0]} - {format % args}")
+
+        return WebhookRequestHandler
+
+    def start(self):
+        """Start listening for updates and, if a public url is configured, register it with Telegram."""
+        log.debug(f"Starting the webhook server on {self.server.server_address}")
+        self.thread.start()
+        url = self.cfg["Telegram"]["Webhook"]["url"]
+        if url:
+            log.debug(f"Setting the webhook url to {url}")
+            self.bot.set_webhook(url=url,
+                                 secret_token=self.cfg["Telegram"]["Webhook"]["secret_token"] or None)
+
+    def stop(self):
+        """Stop the HTTP server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_updates(self, offset: Optional[int] = None, timeout: Optional[float] = None) -> List[telegram.Update]:
+        """Wait up to timeout seconds for at least one update, then return all the updates received so far.
+        The offset is ignored, as the updates pushed by Telegram are acknowledged as soon as they are received."""
+        try:
+            updates = [self.queue.get(timeout=timeout)]
+        except queuem.Empty:
+            return []
+        # Get all the other updates which are already available, up to the same limit of get_updates
+        while len(updates) < 100:
+            try:
+                updates.append(self.queue.get_nowait())
+            except queuem.Empty:
+                break
+        return updates
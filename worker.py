@@ -1,21 +1,29 @@
+import concurrent.futures
 import datetime
+import heapq
+import itertools
+import json
 import logging
 import os
 import queue as queuem
 import re
 import sys
 import threading
+import time
 import traceback
 import uuid
+import weakref
 from html import escape
 from typing import *
 
-import requests
 import sqlalchemy.orm
 import telegram
 from telegram import CallbackQuery
 
+import catalog
 import database as db
+import downloads
+import imaging
 import localization
 import nuconfig
 
@@ -34,6 +42,56 @@ class CancelSignal:
     pass
 
 
+class UpdateQueue(queuem.Queue):
+    """The queue of the updates and signals waiting to be processed by a worker.
+    Putting an item never blocks: when the queue is full, the oldest update is dropped to make room for the new one.
+    Signals are never dropped."""
+
+    def __init__(self, size: int = 0, coalesce_callbacks: bool = False):
+        # The queue itself is unbounded, as the size is enforced by dropping updates
+        super().__init__()
+        # The maximum number of queued updates; 0 means unbounded
+        self.size: int = size
+        # Whether a callback query identical to one already queued should be dropped
+        self.coalesce_callbacks: bool = coalesce_callbacks
+        # The number of updates dropped because the queue was full, and because they duplicated a queued callback
+        self.dropped: int = 0
+        self.coalesced: int = 0
+
+    def _put(self, item):
+        # This is called by put with the queue mutex held
+        if self.coalesce_callbacks and self.__is_queued_callback(item):
+            log.debug("Coalescing a callback query identical to a queued one")
+            self.coalesced += 1
+            return
+        if self.size and len(self.queue) >= self.size:
+            # Find the oldest update, skipping the signals
+            for index, queued in enumerate(self.queue):
+                if isinstance(queued, telegram.Update):
+                    log.debug("Dropping the oldest queued update, as the queue is full")
+                    del self.queue[index]
+                    self.dropped += 1
+                    break
+        self.queue.append(item)
+
+    def __is_queued_callback(self, item) -> bool:
+        """Check if the item is a callback query with the same data and message as one already in the queue."""
+        if not isinstance(item, telegram.Update) or item.callback_query is None:
+            return False
+        return any(isinstance(queued, telegram.Update) and queued.callback_query is not None
+                   and queued.callback_query.data == item.callback_query.data
+                   and self.__callback_message_id(queued.callback_query) ==
+                   self.__callback_message_id(item.callback_query)
+                   for queued in self.queue)
+
+    @staticmethod
+    def __callback_message_id(callback_query: telegram.CallbackQuery) -> Optional[int]:
+        """Get the id of the message containing the pressed inline keyboard."""
+        if callback_query.message is None:
+            return None
+        return callback_query.message.message_id
+
+
 def replace_digits_to_emoji(text: str = None):
     replacements = {'0': '0️⃣', '1': '1️⃣', '2': '2️⃣', '3': '3️⃣', '4': '4️⃣', '5': '5️⃣', '6': '6️⃣', '7': '7️⃣',
                     '8': '8️⃣', '9': '9️⃣'}
@@ -41,8 +99,85 @@ def replace_digits_to_emoji(text: str = None):
     return text
 
 
-class Worker(threading.Thread):
-    """A worker for a single conversation. A new one is created every time the /start command is sent."""
+class ConversationPool:
+    """A fixed-size pool of threads running the conversations of all the workers.
+    A conversation only uses a thread while it is processing an update: when it has to wait for the next one, it is
+    suspended, and the pool resumes it as soon as the update is received."""
+
+    def __init__(self, size: int):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=size, thread_name_prefix="Conversation")
+        # Heap of the (deadline, sequence number, worker) tuples of the suspended conversations, with at most one entry
+        # for every worker: a deadline pushed further by a later wait is only checked when the earlier one is reached
+        self.__timeouts = []
+        self.__timeouts_sequence = itertools.count()
+        self.__timeouts_condition = threading.Condition()
+        # The current (deadline, wait id) of the workers with an entry in the heap
+        # Only keep weak references to the workers, so that ended conversations can be freed right away
+        self.__deadlines: "weakref.WeakKeyDictionary[Worker, Tuple[float, int]]" = weakref.WeakKeyDictionary()
+        # The thread expiring the conversations that have been suspended for too long, started with the first timeout
+        self.__timer: Optional[threading.Thread] = None
+
+    def submit(self, func, *args, **kwargs) -> concurrent.futures.Future:
+        """Run a function in one of the threads of the pool."""
+        return self.executor.submit(func, *args, **kwargs)
+
+    def set_timeout(self, worker: "Worker", wait_id: int, timeout: float):
+        """Expire the wait with the specified id of a worker if it is still suspended after timeout seconds.
+        It replaces the previous timeout of the worker.
+        It's called with the lock of the worker held, so the workers are only called without holding the pool lock."""
+        deadline = time.monotonic() + timeout
+        with self.__timeouts_condition:
+            if self.__timer is None:
+                self.__timer = threading.Thread(target=self.__expire_conversations, name="Conversation timer",
+                                                daemon=True)
+                self.__timer.start()
+            previous = self.__deadlines.get(worker)
+            self.__deadlines[worker] = (deadline, wait_id)
+            # A later deadline is found by the entry already in the heap; only an earlier one needs a new entry
+            if previous is None or deadline < previous[0]:
+                self.__push_timeout(deadline, worker)
+                self.__timeouts_condition.notify()
+
+    def __push_timeout(self, deadline: float, worker: "Worker"):
+        heapq.heappush(self.__timeouts, (deadline, next(self.__timeouts_sequence), weakref.ref(worker)))
+
+    def __expire_conversations(self):
+        """Wait for the deadlines of the suspended conversations, and expire them once they are reached."""
+        while True:
+            with self.__timeouts_condition:
+                # Wait until there is at least a deadline
+                if not self.__timeouts:
+                    self.__timeouts_condition.wait()
+                    continue
+                # Wait until the nearest deadline is reached, or until a nearer one is set
+                deadline, _, worker_ref = self.__timeouts[0]
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self.__timeouts_condition.wait(remaining)
+                    continue
+                heapq.heappop(self.__timeouts)
+                worker = worker_ref()
+                current = self.__deadlines.get(worker) if worker is not None else None
+                # The worker was freed, or its timeout was already expired by another entry
+                if current is None:
+                    del worker
+                    continue
+                current_deadline, wait_id = current
+                # The worker waited again since this entry was pushed: check it again at its new deadline
+                if current_deadline > time.monotonic():
+                    self.__push_timeout(current_deadline, worker)
+                    del worker
+                    continue
+                del self.__deadlines[worker]
+            worker.expire(wait_id)
+            # Don't keep the worker alive while waiting for the next deadline
+            del worker
+
+
+class Worker:
+    """A worker for a single conversation. A new one is created every time the /start command is sent.
+    The conversation is a generator run by a ConversationPool, which suspends itself every time it waits for an
+    update."""
 
     def __init__(self,
                  bot,
@@ -50,10 +185,10 @@ class Worker(threading.Thread):
                  telegram_user: telegram.User,
                  cfg: nuconfig.NuConfig,
                  engine,
-                 *args,
-                 **kwargs):
-        # Initialize the thread
-        super().__init__(name=f"Worker {chat.id}", *args, **kwargs)
+                 pool: ConversationPool,
+                 resume: Optional[dict] = None):
+        # Name the worker like the threads were named, so that the logs stay readable
+        self.name = f"Worker {chat.id}"
         # Store the bot, chat info and config inside the class
         self.bot = bot
         self.chat: telegram.Chat = chat
@@ -62,16 +197,37 @@ class Worker(threading.Thread):
         self.loc = None
         # Open a new database session
         log.debug(f"Opening new database session for {self.name}")
-        self.session = sqlalchemy.orm.sessionmaker(bind=engine)()
+        self.sessionmaker = sqlalchemy.orm.sessionmaker(bind=engine)
+        self.session = self.sessionmaker()
         # Get the user db data from the users and admin tables
         self.user: Optional[db.User] = None
         self.admin: Optional[db.Admin] = None
         # The sending pipe is stored in the Worker class, allowing the forwarding of messages to the chat process
-        self.queue = queuem.Queue()
+        self.queue = UpdateQueue(size=cfg["Telegram"]["chat_queue_size"],
+                                 coalesce_callbacks=cfg["Telegram"]["coalesce_callbacks"])
         # # The current active invoice payload; reject all invoices with a different payload
         # self.invoice_payload = None
         # The price class of this worker.
         self.Price = self.price_factory()
+        # The pool running the conversation
+        self.pool: ConversationPool = pool
+        # The checkpoint to resume the conversation from, if it is being resumed after a restart
+        self.resume: Optional[dict] = resume
+        # The category levels of the order menu, saved in the checkpoints
+        self.__order_level: List[Optional[int]] = [None]
+        # The conversation generator; None before the worker is started and after the conversation has ended
+        self.__conversation: Optional[Generator[None, Any, None]] = None
+        # Lock protecting the suspension state of the conversation
+        self.__lock = threading.Lock()
+        # Whether the conversation is suspended waiting for an update, and the id of the current wait
+        self.__waiting: bool = False
+        self.__wait_id: int = 0
+        # Set when the conversation has ended
+        self.__ended = threading.Event()
+        # The functions to call when the conversation ends, protected by the lock
+        self.__ended_callbacks: List[Callable[[], Any]] = []
+        # Whether the worker has been replaced by another one: it shouldn't send anything anymore
+        self.__stopping: bool = False
 
     def __repr__(self):
         return f"<{self.__class__.__qualname__} {self.chat.id}>"
@@ -167,6 +323,110 @@ class Worker(threading.Thread):
 
         return Price
 
+    def start(self, after: Optional["Worker"] = None):
+        """Start the conversation in the pool.
+        If after is specified, the conversation starts only when the conversation of that worker has ended, so that
+        the two never use the database or the chat together."""
+        self.__conversation = self.run()
+        if after is None:
+            self.pool.submit(self.__resume, None)
+        else:
+            after.__call_when_ended(lambda: self.pool.submit(self.__resume, None))
+
+    def __call_when_ended(self, func: Callable[[], Any]):
+        """Call a function when the conversation ends, or right away if it has already ended."""
+        with self.__lock:
+            if not self.__ended.is_set():
+                self.__ended_callbacks.append(func)
+                return
+        func()
+
+    def put(self, item: Union[telegram.Update, CancelSignal, StopSignal]):
+        """Send an update or a signal to the conversation, resuming it if it was waiting for one."""
+        self.queue.put(item)
+        with self.__lock:
+            # If the conversation is running, it will get the item from the queue by itself
+            if not self.__waiting:
+                return
+            try:
+                item = self.queue.get_nowait()
+            except queuem.Empty:
+                return
+            self.__waiting = False
+        self.pool.submit(self.__resume, item)
+
+    def expire(self, wait_id: int):
+        """Stop the conversation if it is still suspended in the wait with the specified id."""
+        with self.__lock:
+            if not self.__waiting or self.__wait_id != wait_id:
+                return
+            self.__waiting = False
+        self.pool.submit(self.__resume, StopSignal("timeout"))
+
+    def __resume(self, item):
+        """Resume the conversation with an update, and keep it running until it has to wait for an update which hasn't
+        been received yet."""
+        # Rename the pool thread while it runs the conversation, so that the logs stay readable
+        thread = threading.current_thread()
+        pool_thread_name = thread.name
+        thread.name = self.name
+        try:
+            # A worker replaced before starting is dropped without running any of its conversation
+            if item is None and self.__stopping:
+                log.debug("Replaced before starting, not running the conversation")
+                self.__end()
+                return
+            while True:
+                # noinspection PyBroadException
+                try:
+                    self.__conversation.send(item)
+                # The conversation has ended, either normally or through __graceful_stop
+                except (StopIteration, SystemExit):
+                    self.__end()
+                    return
+                except Exception as e:
+                    log.error(f"Exception in {self}: {e}")
+                    traceback.print_exception(*sys.exc_info())
+                    self.__end()
+                    return
+                # The conversation is waiting for the next update: continue with the next queued item, if any
+                with self.__lock:
+                    self.__wait_id += 1
+                    wait_id = self.__wait_id
+                    try:
+                        item = self.queue.get_nowait()
+                    except queuem.Empty:
+                        # Suspend the conversation until an item is put in the queue
+                        self.__waiting = True
+                        # Set the timeout before releasing the lock, so that it can't replace the one of a later wait
+                        self.pool.set_timeout(self, wait_id, self.cfg["Telegram"]["conversation_timeout"])
+                        break
+        finally:
+            thread.name = pool_thread_name
+
+    def __end(self):
+        """Mark the conversation as ended and release its resources."""
+        self.__conversation = None
+        # Close the database session, which isn't closed by __graceful_stop if the conversation crashed
+        self.session.close()
+        with self.__lock:
+            self.__ended.set()
+            callbacks, self.__ended_callbacks = self.__ended_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def is_alive(self) -> bool:
+        """Check if the conversation has been started and hasn't ended yet."""
+        return self.__conversation is not None and not self.__ended.is_set()
+
+    def is_idle(self) -> bool:
+        """Check if the conversation is suspended waiting for an update."""
+        return self.__waiting
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the conversation to end."""
+        return self.__ended.wait(timeout)
+
     def run(self):
         """The conversation code."""
         log.debug("Starting conversation")
@@ -200,15 +460,25 @@ class Worker(threading.Thread):
                 log.warning(f"User was auto-promoted to Admin as no other admins existed: {self.user}")
         # Create the localization object
         self.__create_localization()
+        # Don't send anything if the worker has been replaced while starting
+        if self.__stopping:
+            log.debug("Replaced while starting, ending the conversation")
+            return
         # Capture exceptions that occour during the conversation
         # noinspection PyBroadException
         try:
-            # Welcome the user to the bot
-            if self.cfg["Appearance"]["display_welcome_message"] == "yes":
-                self.bot.send_message(self.chat.id, self.loc.get("conversation_after_start"))
+            # If the conversation is being resumed, continue placing the order from the checkpoint
+            if self.resume is not None:
+                yield from self.__order_menu(resume=self.resume)
+            # Otherwise, discard the checkpoint of the previous conversation, if any
+            else:
+                self.__delete_checkpoint()
+                # Welcome the user to the bot
+                if self.cfg["Appearance"]["display_welcome_message"] == "yes":
+                    self.bot.send_message(self.chat.id, self.loc.get("conversation_after_start"))
             # If the user is not an admin, send him to the user menu
             if self.admin is None:
-                self.__user_menu()
+                yield from self.__user_menu()
             # If the user is an admin, send him to the admin menu
             else:
                 # Clear the live orders flag
@@ -216,7 +486,7 @@ class Worker(threading.Thread):
                 # Commit the change
                 self.session.commit()
                 # Open the admin menu
-                self.__admin_menu()
+                yield from self.__admin_menu()
         except Exception as e:
             # Try to notify the user of the exception
             # noinspection PyBroadException
@@ -232,11 +502,12 @@ class Worker(threading.Thread):
         return self.loc is not None
 
     def stop(self, reason: str = ""):
-        """Gracefully stop the worker process"""
-        # Send a stop message to the thread
-        self.queue.put(StopSignal(reason))
-        # Wait for the thread to stop
-        self.join()
+        """Gracefully stop the worker process.
+        The conversation ends in the pool after processing the updates already queued: use join to wait for it.
+        If the conversation hasn't started yet, or is still starting, it ends without sending anything."""
+        self.__stopping = True
+        # Send a stop message to the conversation
+        self.put(StopSignal(reason))
 
     def update_user(self) -> db.User:
         """Update the user data."""
@@ -244,17 +515,13 @@ class Worker(threading.Thread):
         self.user = self.session.query(db.User).filter(db.User.user_id == self.chat.id).one_or_none()
         return self.user
 
-    # noinspection PyUnboundLocalVariable
-    def __receive_next_update(self) -> telegram.Update:
+    def __receive_next_update(self) -> Generator[None, Any, telegram.Update]:
         """Get the next update from the queue.
-        If no update is found, block the process until one is received.
-        If a stop signal is sent, try to gracefully stop the thread."""
-        # Pop data from the queue
-        try:
-            data = self.queue.get(timeout=self.cfg["Telegram"]["conversation_timeout"])
-        except queuem.Empty:
-            # If the conversation times out, gracefully stop the thread
-            self.__graceful_stop(StopSignal("timeout"))
+        If no update is found, suspend the conversation until one is received.
+        If a stop signal is sent, try to gracefully stop the conversation."""
+        # Wait for the pool to resume the conversation with the next queued item
+        # If the conversation times out, the pool resumes it with a timeout stop signal
+        data = yield
         # Check if the data is a stop signal instance
         if isinstance(data, StopSignal):
             # Gracefully stop the process
@@ -269,7 +536,7 @@ class Worker(threading.Thread):
         log.debug("Waiting for a specific message...")
         while True:
             # Get the next update
-            update = self.__receive_next_update()
+            update = yield from self.__receive_next_update()
             # If a CancelSignal is received...
             if isinstance(update, CancelSignal):
                 # And the wait is cancellable...
@@ -296,7 +563,7 @@ class Worker(threading.Thread):
         log.debug("Waiting for a regex...")
         while True:
             # Get the next update
-            update = self.__receive_next_update()
+            update = yield from self.__receive_next_update()
             # If a CancelSignal is received...
             if isinstance(update, CancelSignal):
                 # And the wait is cancellable...
@@ -325,7 +592,7 @@ class Worker(threading.Thread):
         log.debug("Waiting for a regex...")
         while True:
             # Get the next update
-            update = self.__receive_next_update()
+            update = yield from self.__receive_next_update()
             # If a CancelSignal is received...
             if isinstance(update, CancelSignal):
                 # And the wait is cancellable...
@@ -356,7 +623,7 @@ class Worker(threading.Thread):
         log.debug("Waiting for a PreCheckoutQuery...")
         while True:
             # Get the next update
-            update = self.__receive_next_update()
+            update = yield from self.__receive_next_update()
             # If a CancelSignal is received...
             if isinstance(update, CancelSignal):
                 # And the wait is cancellable...
@@ -378,7 +645,7 @@ class Worker(threading.Thread):
         log.debug("Waiting for a SuccessfulPayment...")
         while True:
             # Get the next update
-            update = self.__receive_next_update()
+            update = yield from self.__receive_next_update()
             # If a CancelSignal is received...
             if isinstance(update, CancelSignal):
                 # And the wait is cancellable...
@@ -402,7 +669,7 @@ class Worker(threading.Thread):
         log.debug("Waiting for a photo...")
         while True:
             # Get the next update
-            update = self.__receive_next_update()
+            update = yield from self.__receive_next_update()
             # If a CancelSignal is received...
             if isinstance(update, CancelSignal):
                 # And the wait is cancellable...
@@ -426,7 +693,7 @@ class Worker(threading.Thread):
         regex = r"(([+\(]{0,1}\d{0,3}[ -]{0,1}\({0,1}\d{2}\){0,1}[ -]{0,1}\d{3}[ -]{0,1}[ -]{0,1}\d{2}[ -]{0,1}\d{2}))"
         while True:
             # Get the next update
-            update = self.__receive_next_update()
+            update = yield from self.__receive_next_update()
             # If a CancelSignal is received...
             if isinstance(update, CancelSignal):
                 # And the wait is cancellable...
@@ -456,7 +723,7 @@ class Worker(threading.Thread):
         log.debug("Waiting for a CallbackQuery...")
         while True:
             # Get the next update
-            update = self.__receive_next_update()
+            update = yield from self.__receive_next_update()
             # If a CancelSignal is received...
             if isinstance(update, CancelSignal):
                 # And the wait is cancellable...
@@ -502,7 +769,7 @@ class Worker(threading.Thread):
             # Send the keyboard
             self.bot.send_message(self.chat.id, self.loc.get("conversation_admin_select_user"), reply_markup=keyboard)
             # Wait for a reply
-            reply = self.__wait_for_regex("user_([0-9]+)", cancellable=True)
+            reply = yield from self.__wait_for_regex("user_([0-9]+)", cancellable=True)
             # Propagate CancelSignals
             if isinstance(reply, CancelSignal):
                 return reply
@@ -534,7 +801,7 @@ class Worker(threading.Thread):
                                   reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True,
                                                                             resize_keyboard=True))
             # Wait for a reply from the user
-            selection = self.__wait_for_specific_message([
+            selection = yield from self.__wait_for_specific_message([
                 self.loc.get("menu_order"),
                 self.loc.get("menu_rate"),
             ])
@@ -543,10 +810,10 @@ class Worker(threading.Thread):
             # If the user has selected the Order option...
             if selection == self.loc.get("menu_order"):
                 # Open the order menu
-                self.__order_menu()
+                yield from self.__order_menu()
             if selection == self.loc.get("menu_rate"):
                 # Open the order menu
-                self.__rate_menu()
+                yield from self.__rate_menu()
 
     def __rate_menu(self):
         rate_kb = [[telegram.KeyboardButton(self.loc.get("menu_rate_5"))],
@@ -556,7 +823,7 @@ class Worker(threading.Thread):
                    [telegram.KeyboardButton(self.loc.get("menu_rate_1"))]]
         self.bot.send_message(self.chat.id, self.loc.get("conversation_rate"),
                               reply_markup=telegram.ReplyKeyboardMarkup(rate_kb, resize_keyboard=True))
-        rate = self.__wait_for_specific_message([self.loc.get("menu_rate_5"),
+        rate = yield from self.__wait_for_specific_message([self.loc.get("menu_rate_5"),
                                                  self.loc.get("menu_rate_4"),
                                                  self.loc.get("menu_rate_3"),
                                                  self.loc.get("menu_rate_2"),
@@ -567,7 +834,7 @@ class Worker(threading.Thread):
                                   [[telegram.KeyboardButton(self.loc.get("menu_skip"))]],
                                   resize_keyboard=True
                               ))
-        notes = self.__wait_for_regex(r"(.*)")
+        notes = yield from self.__wait_for_regex(r"(.*)")
         if notes == self.loc.get("menu_skip"):
             notes = ""
         new_rate = self.loc.get("new_rate_text",
@@ -576,13 +843,25 @@ class Worker(threading.Thread):
                                 comment=notes)
         self.bot.send_message(self.cfg["Administration"]["rates_channel"], new_rate)
 
-    def __order_menu(self):
+    def __order_menu(self, resume: Optional[dict] = None):
         level = [None]
-        cart: Dict[List[db.Product, int, db.Size]] = {}
+        cart: Dict[int, List[Union[catalog.CatalogProduct, int, catalog.CatalogSize]]] = {}
+        # Restore the order being placed before the restart
+        if resume is not None:
+            level, cart = self.__load_checkpoint(resume)
+        # Restore the category levels before anything saves a checkpoint, which includes them
+        self.__order_level = level
+        # If the user was checking out, bring them back to the cart
+        if resume is not None and resume["step"] != "browse":
+            cart = yield from self.__check_cart(cart=cart)
+            if len(cart) == 0:
+                self.__delete_checkpoint()
+                return
         while True:
-            categories = self.session.query(db.Category).filter_by(is_active=True, deleted=False,
-                                                                   parent_id=level[-1]).all()
-            products = self.session.query(db.Product).filter_by(deleted=False, category_id=level[-1]).all()
+            # Browse the cached catalog, without querying the database
+            shop = self.__get_catalog()
+            categories = shop.subcategories(level[-1])
+            products = shop.category_products(level[-1])
             # buttons = [[telegram.KeyboardButton(self.loc.get("menu_home"))],
             #            [telegram.KeyboardButton(self.loc.get("menu_cart"))]]
             buttons = []
@@ -619,12 +898,14 @@ class Worker(threading.Thread):
                                             reply_markup=telegram.ReplyKeyboardMarkup(
                                                 buttons, one_time_keyboard=False,
                                                 resize_keyboard=True))
-            choice = self.__wait_for_specific_message(category_names + product_names \
+            self.__save_checkpoint("browse", cart)
+            choice = yield from self.__wait_for_specific_message(category_names + product_names \
                                                       + [self.loc.get("menu_back"),
                                                          self.loc.get("menu_home"),
                                                          self.loc.get("menu_cart")], cancellable=True)
             if choice == self.loc.get("menu_home"):
                 self.bot.delete_message(self.chat.id, message.message_id)
+                self.__delete_checkpoint()
                 break
             elif choice == self.loc.get("menu_back"):
                 self.bot.delete_message(self.chat.id, message.message_id)
@@ -632,41 +913,40 @@ class Worker(threading.Thread):
                 pass
             elif choice == self.loc.get("menu_cart"):
                 self.bot.delete_message(self.chat.id, message.message_id)
-                cart = self.__check_cart(cart=cart)
+                cart = yield from self.__check_cart(cart=cart)
                 if len(cart) == 0:
+                    self.__delete_checkpoint()
                     break
             elif choice in category_names:
                 self.bot.delete_message(self.chat.id, message.message_id)
-                category = self.session.query(db.Category).filter_by(is_active=True, deleted=False,
-                                                                     name=choice).one()
+                category = shop.categories_by_name[choice]
                 level.append(category.id)
             elif choice in product_names:
                 self.bot.delete_message(self.chat.id, message.message_id)
-                product = self.session.query(db.Product).filter_by(deleted=False, name=choice).one()
+                product = shop.products_by_name[choice]
                 try:
                     p_size = cart[product.id][2]
                     p_qty = cart[product.id][1]
                     cart[product.id] = [product, p_qty, p_size]
                 except:
                     cart[product.id] = [product, 0, None]
-                cart = self.__product_pre_set_menu(product=product, cart=cart)
+                cart = yield from self.__product_pre_set_menu(product=product, cart=cart)
         return
 
     def __product_pre_set_menu(self, cart, product):
-        message = product.send_as_message(w=self, chat_id=self.chat.id, session=self.session)
-        if len(product.children) != 0:
+        message = product.send_as_message(w=self, chat_id=self.chat.id)
+        if len(product.sizes) != 0:
             sizes_list = []
             row = []
-            for size in product.children:
-                if size.deleted is False:
-                    row.append(telegram.InlineKeyboardButton(
-                        str(size.name + " - " + str(size.price)), callback_data=str(size.id)))
+            for size in product.sizes:
+                row.append(telegram.InlineKeyboardButton(
+                    str(size.name + " - " + str(size.price)), callback_data=str(size.id)))
             sizes_list.append(row)
             sizes_keyboard = telegram.InlineKeyboardMarkup(sizes_list)
             size_msg = self.bot.send_message(self.chat.id, self.loc.get("conversation_select_product_size"),
                                              reply_markup=sizes_keyboard)
-            callback = self.__wait_for_inlinekeyboard_callback()
-            size = self.session.query(db.Size).filter_by(deleted=False, id=int(callback.data)).one()
+            callback = yield from self.__wait_for_inlinekeyboard_callback()
+            size = self.__get_catalog().sizes[int(callback.data)]
             size_id = size.id
             p = cart.get(product.id)
             p[2] = size
@@ -685,33 +965,31 @@ class Worker(threading.Thread):
                                                                  callback_data="cart_remove")])
         inline_keyboard = telegram.InlineKeyboardMarkup(inline_buttons)
         # Edit the sent message and add the inline keyboard
-        if product.image is None:
+        if not product.has_image:
             self.bot.edit_message_text(chat_id=self.chat.id,
-                                       message_id=message['result']['message_id'],
+                                       message_id=message.message_id,
                                        text=product.text(w=self, cart_qty=cart[product.id][1],
-                                                         size_id=size_id,
-                                                         session=self.session),
+                                                         size_id=size_id),
                                        reply_markup=inline_keyboard)
         else:
             self.bot.edit_message_caption(chat_id=self.chat.id,
-                                          message_id=message['result']['message_id'],
+                                          message_id=message.message_id,
                                           caption=product.text(w=self, cart_qty=cart[product.id][1],
-                                                               size_id=size_id,
-                                                               session=self.session),
+                                                               size_id=size_id),
                                           reply_markup=inline_keyboard)
-        callback = self.__wait_for_inlinekeyboard_callback()
+        callback = yield from self.__wait_for_inlinekeyboard_callback()
         if callback.data == "cart_remove":
             cart[product.id][1] = 0
-            self.bot.delete_message(self.chat.id, message['result']['message_id'])
+            self.bot.delete_message(self.chat.id, message.message_id)
             self.bot.send_message(self.chat.id, self.loc.get("success_product_removed_from_cart",
-                                                             product=cart.get(product.id)[0]))
+                                                             product=cart.get(product.id)[0].name))
         else:
             # Get the selected product, ensuring it exists
             p = cart.get(product.id)
             product = p[0]
             # Add 1 copy to the cart
             cart[product.id][1] += int(callback.data)
-            self.bot.delete_message(self.chat.id, message['result']['message_id'])
+            self.bot.delete_message(self.chat.id, message.message_id)
             qty = replace_digits_to_emoji(text=str(cart[product.id][1]))
             name = product.name + (" " + p[2].name if p[2] is not None else "")
             self.bot.send_message(self.chat.id, self.loc.get("success_product_added_to_cart",
@@ -750,13 +1028,14 @@ class Worker(threading.Thread):
                                                                        cart_str=cart_str,
                                                                        total=total),
                                             reply_markup=telegram.InlineKeyboardMarkup(inline_buttons))
-            callback = self.__wait_for_inlinekeyboard_callback(cancellable=True)
+            self.__save_checkpoint("cart", cart)
+            callback = yield from self.__wait_for_inlinekeyboard_callback(cancellable=True)
             if isinstance(callback, CancelSignal):
                 self.bot.delete_message(self.chat.id, message.message_id)
                 return cart
             elif callback.data == "cmd_done":
-                cart = self.__confirm_order(cart=cart, message_id=message.message_id, cart_str=cart_str, total=total)
-                cart: Dict[List[db.Product, int]] = {}
+                cart = yield from self.__confirm_order(cart=cart, message_id=message.message_id, cart_str=cart_str, total=total)
+                cart: Dict[int, List[Union[catalog.CatalogProduct, int, catalog.CatalogSize]]] = {}
                 return cart
             else:
                 self.bot.delete_message(self.chat.id, message.message_id)
@@ -765,6 +1044,7 @@ class Worker(threading.Thread):
         return
 
     def __confirm_order(self, cart, message_id, cart_str, total):
+        self.__save_checkpoint("checkout", cart)
         while True:
             inline_markup_address = telegram.InlineKeyboardMarkup([[
                 telegram.InlineKeyboardButton(self.loc.get("menu_cancel"), callback_data="cmd_cancel"),
@@ -779,7 +1059,7 @@ class Worker(threading.Thread):
                                        message_id=message_id,
                                        text=self.loc.get("ask_for_address"),
                                        reply_markup=inline_markup_address)
-            answer = self.__wait_for_inlinekeyboard_callback(accept_location=True, accept_text=True, cancellable=True)
+            answer = yield from self.__wait_for_inlinekeyboard_callback(accept_location=True, accept_text=True, cancellable=True)
             if not isinstance(answer, CallbackQuery):
                 is_pickup = False
                 if answer.location:
@@ -796,13 +1076,13 @@ class Worker(threading.Thread):
                 telegram.KeyboardButton(self.loc.get("menu_share_phone"), request_contact=True)
             ]], resize_keyboard=True, one_time_keyboard=True)
             self.bot.send_message(self.chat.id, self.loc.get("ask_for_phone"), reply_markup=phone_request)
-            phone = self.__wait_for_contact()
+            phone = yield from self.__wait_for_contact()
             skip_markup = telegram.InlineKeyboardMarkup([[
                 telegram.InlineKeyboardButton(self.loc.get("menu_skip"), callback_data="cmd_cancel")
             ]])
             self.bot.send_message(self.chat.id, self.loc.get("ask_order_notes"), reply_markup=skip_markup)
             # TODO: Выбор формы оплаты
-            notes = self.__wait_for_regex(r"(.*)", cancellable=True)
+            notes = yield from self.__wait_for_regex(r"(.*)", cancellable=True)
             if isinstance(notes, CancelSignal):
                 notes = ""
             confirm = telegram.InlineKeyboardMarkup([[
@@ -815,7 +1095,7 @@ class Worker(threading.Thread):
                                       address=address,
                                       comment=notes)
             self.bot.send_message(self.chat.id, final_text, reply_markup=confirm)
-            callback = self.__wait_for_inlinekeyboard_callback(cancellable=True)
+            callback = yield from self.__wait_for_inlinekeyboard_callback(cancellable=True)
             if isinstance(callback, CancelSignal):
                 return cart
             elif callback.data == "cmd_confirm":
@@ -853,7 +1133,7 @@ class Worker(threading.Thread):
                 size_id = None
             # Create {quantity} new OrderItems
             for i in range(0, cart[product][1]):
-                order_item = db.OrderItem(product=cart[product][0],
+                order_item = db.OrderItem(product_id=cart[product][0].id,
                                           order_id=order.order_id,
                                           size_id=size_id)
                 self.session.add(order_item)
@@ -867,12 +1147,9 @@ class Worker(threading.Thread):
                                       name=self.user.mention(),
                                       phone=phone,
                                       comment=notes)
-        self.bot.send_message(self.cfg["Administration"]["orders_channel"], new_order_text)
-        if location is not None:
-            self.bot.send_location(chat_id=self.cfg["Administration"]["orders_channel"],
-                                   latitude=location.latitude,
-                                   longitude=location.longitude)
         self.session.commit()
+        # Notify the orders channel and the admins without making the user wait for them
+        self.__order_notify_admins(order_text=new_order_text, location=location)
 
     def __get_cart_value(self, cart):
         # Calculate total items value in cart
@@ -899,16 +1176,19 @@ class Worker(threading.Thread):
         self.session.add(transaction)
         # Commit all the changes
         self.session.commit()
-        # Notify admins about new transation
-        self.__order_notify_admins(order=order)
-
-    def __order_notify_admins(self, order):
-        # Notify the user of the order result
-        self.bot.send_message(self.chat.id, self.loc.get("success_order_created", order=order.text(w=self,
-                                                                                                   session=self.session,
-                                                                                                   user=True)))
+
+    def __order_notify_admins(self, order_text, location=None):
+        """Broadcast a new order to the orders channel and to the admins in Live Orders mode, in the background."""
+        # Send the order to the orders channel, with its location if there is one
+        channel_calls = [("send_message", {"text": order_text})]
+        if location is not None:
+            channel_calls.append(("send_location", {"latitude": location.latitude,
+                                                    "longitude": location.longitude}))
+        self.bot.broadcast([self.cfg["Administration"]["orders_channel"]], channel_calls)
         # Notify the admins (in Live Orders mode) of the new order
         admins = self.session.query(db.Admin).filter_by(live_mode=True).all()
+        if not admins:
+            return
         # Create the order keyboard
         order_keyboard = telegram.InlineKeyboardMarkup(
             [
@@ -916,11 +1196,9 @@ class Worker(threading.Thread):
                 [telegram.InlineKeyboardButton(self.loc.get("menu_refund"), callback_data="order_refund")]
             ])
         # Notify them of the new placed order
-        for admin in admins:
-            self.bot.send_message(admin.user_id,
-                                  self.loc.get('notification_order_placed',
-                                               order=order.text(w=self, session=self.session)),
-                                  reply_markup=order_keyboard)
+        self.bot.broadcast([admin.user_id for admin in admins],
+                           [("send_message", {"text": self.loc.get("notification_order_placed", order=order_text),
+                                              "reply_markup": order_keyboard})])
 
     def __order_status(self):
         """Display the status of the sent orders."""
@@ -964,7 +1242,7 @@ class Worker(threading.Thread):
                                                                             resize_keyboard=True))
             # Wait for a reply from the user
             # TODO: Настройка форм оплаты: добавление, настройка, включение и выключение, удаление
-            selection = self.__wait_for_specific_message([self.loc.get("menu_products"),
+            selection = yield from self.__wait_for_specific_message([self.loc.get("menu_products"),
                                                           self.loc.get("menu_categories"),
                                                           # self.loc.get("menu_orders"),
                                                           self.loc.get("menu_user_mode"),
@@ -972,21 +1250,21 @@ class Worker(threading.Thread):
             # If the user has selected the Products option...
             if selection == self.loc.get("menu_products"):
                 # Open the products menu
-                self.__products_menu()
+                yield from self.__products_menu()
             # If the user has selected the Categories option...
             if selection == self.loc.get("menu_categories"):
                 # Open the categories menu
-                self.__categories_menu()
+                yield from self.__categories_menu()
             # If the user has selected the User mode option...
             elif selection == self.loc.get("menu_user_mode"):
                 # Tell the user how to go back to admin menu
                 self.bot.send_message(self.chat.id, self.loc.get("conversation_switch_to_user_mode"))
                 # Start the bot in user mode
-                self.__user_menu()
+                yield from self.__user_menu()
             # If the user has selected the Add Admin option...
             elif selection == self.loc.get("menu_edit_admins"):
                 # Open the edit admin menu
-                self.__add_admin()
+                yield from self.__add_admin()
 
     def __categories_menu(self):
         """Display the admin menu to select a category to edit."""
@@ -1006,7 +1284,7 @@ class Worker(threading.Thread):
                               reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True,
                                                                         resize_keyboard=True))
         # Wait for a reply from the user
-        selection = self.__wait_for_specific_message(category_names, cancellable=True)
+        selection = yield from self.__wait_for_specific_message(category_names, cancellable=True)
         # If the user has selected the Cancel option...
         if isinstance(selection, CancelSignal):
             # Exit the menu
@@ -1014,17 +1292,17 @@ class Worker(threading.Thread):
         # If the user has selected the Add Category option...
         elif selection == self.loc.get("menu_add_category"):
             # Open the add category menu
-            self.__edit_category_menu()
+            yield from self.__edit_category_menu()
         # If the user has selected the Remove Category option...
         elif selection == self.loc.get("menu_delete_category"):
             # Open the delete category menu
-            self.__delete_category_menu()
+            yield from self.__delete_category_menu()
         # If the user has selected a category
         else:
             # Find the selected category
             category = self.session.query(db.Category).filter_by(name=selection, deleted=False).one()
             # Open the edit menu for that specific category
-            self.__edit_category_menu(category=category)
+            yield from self.__edit_category_menu(category=category)
 
     def __edit_category_menu(self, category: Optional[db.Category] = None):
         """Add a category to the database or edit an existing one."""
@@ -1041,7 +1319,7 @@ class Worker(threading.Thread):
                 self.bot.send_message(self.chat.id, self.loc.get("edit_current_value", value=escape(category.name)),
                                       reply_markup=cancel)
             # Wait for an answer
-            name = self.__wait_for_regex(r"(.*)", cancellable=bool(category))
+            name = yield from self.__wait_for_regex(r"(.*)", cancellable=bool(category))
             # Ensure a product with that name doesn't already exist
             if (category and isinstance(name, CancelSignal)) or \
                     self.session.query(db.Category).filter_by(name=name, deleted=False).one_or_none() in [None,
@@ -1056,7 +1334,7 @@ class Worker(threading.Thread):
             parents = self.session.query(db.Category).filter_by(deleted=False, is_active=True).all()
             parent_id = None
         if len(parents) != 0:
-            parent_id = self.__assign_category(category=category, product=None)
+            parent_id = yield from self.__assign_category(category=category, product=None)
         if not category:
             name = name if not isinstance(name, CancelSignal) else category.name
             new_category = db.Category(
@@ -1073,6 +1351,8 @@ class Worker(threading.Thread):
             category.parent_id = parent_id
             self.bot.send_message(self.chat.id, self.loc.get("success_edited_category", name=name))
         self.session.commit()
+        # Show the change to the customers
+        catalog.invalidate()
 
     def __assign_category(self, category, product):
         if category:
@@ -1103,7 +1383,7 @@ class Worker(threading.Thread):
                                                                         one_time_keyboard=True))
         skip_msg = self.bot.send_message(self.chat.id, self.loc.get("conversation_skip_parent_assignment"),
                                          reply_markup=skip_markup)
-        choice = self.__wait_for_specific_message(
+        choice = yield from self.__wait_for_specific_message(
             [parent.name for parent in parents] + [self.loc.get("menu_no_category")],
             cancellable=True)
         if isinstance(choice, CancelSignal):
@@ -1132,7 +1412,7 @@ class Worker(threading.Thread):
         self.bot.send_message(self.chat.id, self.loc.get("conversation_admin_select_category_to_delete"),
                               reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True))
         # Wait for a reply from the user
-        selection = self.__wait_for_specific_message(category_names, cancellable=True)
+        selection = yield from self.__wait_for_specific_message(category_names, cancellable=True)
         if isinstance(selection, CancelSignal):
             # Exit the menu
             return
@@ -1142,6 +1422,8 @@ class Worker(threading.Thread):
             # "Delete" the category by setting the deleted flag to true
             category.deleted = True
             self.session.commit()
+            # Hide the category from the customers
+            catalog.invalidate()
             # Notify the user
             self.bot.send_message(self.chat.id, self.loc.get("success_category_deleted"))
 
@@ -1163,7 +1445,7 @@ class Worker(threading.Thread):
                               reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True,
                                                                         resize_keyboard=True))
         # Wait for a reply from the user
-        selection = self.__wait_for_specific_message(product_names, cancellable=True)
+        selection = yield from self.__wait_for_specific_message(product_names, cancellable=True)
         # If the user has selected the Cancel option...
         if isinstance(selection, CancelSignal):
             # Exit the menu
@@ -1171,17 +1453,17 @@ class Worker(threading.Thread):
         # If the user has selected the Add Product option...
         elif selection == self.loc.get("menu_add_product"):
             # Open the add product menu
-            self.__edit_product_menu()
+            yield from self.__edit_product_menu()
         # If the user has selected the Remove Product option...
         elif selection == self.loc.get("menu_delete_product"):
             # Open the delete product menu
-            self.__delete_product_menu()
+            yield from self.__delete_product_menu()
         # If the user has selected a product
         else:
             # Find the selected product
             product = self.session.query(db.Product).filter_by(name=selection, deleted=False).one()
             # Open the edit menu for that specific product
-            self.__edit_product_menu(product=product)
+            yield from self.__edit_product_menu(product=product)
 
     def __edit_product_menu(self, product: Optional[db.Product] = None):
         """Add a product to the database or edit an existing one."""
@@ -1189,7 +1471,7 @@ class Worker(threading.Thread):
         # Create an inline keyboard with a single skip button
         cancel = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(self.loc.get("menu_skip"),
                                                                                callback_data="cmd_cancel")]])
-        category_id = self.__assign_category(category=None, product=product)
+        category_id = yield from self.__assign_category(category=None, product=product)
         # Ask for the product name until a valid product name is specified
         while True:
             # Ask the question to the user
@@ -1199,7 +1481,7 @@ class Worker(threading.Thread):
                 self.bot.send_message(self.chat.id, self.loc.get("edit_current_value", value=escape(product.name)),
                                       reply_markup=cancel)
             # Wait for an answer
-            name = self.__wait_for_regex(r"(.*)", cancellable=bool(product))
+            name = yield from self.__wait_for_regex(r"(.*)", cancellable=bool(product))
             # Ensure a product with that name doesn't already exist
             if (product and isinstance(name, CancelSignal)) or \
                     self.session.query(db.Product).filter_by(name=name, deleted=False).one_or_none() in [None, product]:
@@ -1214,7 +1496,7 @@ class Worker(threading.Thread):
                                   self.loc.get("edit_current_value", value=escape(product.description)),
                                   reply_markup=cancel)
         # Wait for an answer
-        description = self.__wait_for_regex(r"(.*)", cancellable=bool(product))
+        description = yield from self.__wait_for_regex(r"(.*)", cancellable=bool(product))
         if product:
             children = self.session.query(db.Size).filter_by(product_id=product.id, deleted=False).all()
             if len(children) != 0:
@@ -1234,7 +1516,7 @@ class Worker(threading.Thread):
             self.bot.send_message(self.chat.id, current_sizes, reply_markup=cancel)
         # Accepts size list in format:
         # 12 [cm, см, сантиметров] - 123456
-        sizes = self.__wait_for_regex(r"(((([\d ,.]{0,6}.{0,15}( - ){0,1}\d{4,9}\s{0,1}){1,5}|([XxХх]){1})))",
+        sizes = yield from self.__wait_for_regex(r"(((([\d ,.]{0,6}.{0,15}( - ){0,1}\d{4,9}\s{0,1}){1,5}|([XxХх]){1})))",
                                       cancellable=bool(product))
         if isinstance(sizes, CancelSignal):
             db_sizes = self.session.query(db.Size).filter_by(product_id=product.id, deleted=False).all()
@@ -1266,7 +1548,7 @@ class Worker(threading.Thread):
                                                           else self.loc.get("not_in_price_list"))),
                                       reply_markup=cancel)
             # Wait for an answer
-            price = self.__wait_for_regex(r"([0-9]+(?:[.,][0-9]{1,2})?|[XxХх])",
+            price = yield from self.__wait_for_regex(r"([0-9]+(?:[.,][0-9]{1,2})?|[XxХх])",
                                           cancellable=True)
             # If the price is skipped
             if isinstance(price, CancelSignal):
@@ -1278,7 +1560,7 @@ class Worker(threading.Thread):
         # Ask for the product image
         self.bot.send_message(self.chat.id, self.loc.get("ask_product_image"), reply_markup=cancel)
         # Wait for an answer
-        photo_list = self.__wait_for_photo(cancellable=True)
+        photo_list = yield from self.__wait_for_photo(cancellable=True)
         # If a new product is being added...
         if not product:
             # Create the db record for the product
@@ -1339,16 +1621,63 @@ class Worker(threading.Thread):
                     largest_photo = photo
             # Get the file object associated with the photo
             photo_file = self.bot.get_file(largest_photo.file_id)
-            # Notify the user that the bot is downloading the image and might be inactive for a while
+            # Notify the user that the bot is downloading the image in the background
             self.bot.send_message(self.chat.id, self.loc.get("downloading_image"))
-            self.bot.send_chat_action(self.chat.id, action="upload_photo")
-            # Set the image for that product
-            product.set_image(photo_file)
         # Commit the session changes
         self.session.commit()
+        # Show the change to the customers
+        catalog.invalidate()
+        # Download the image in the background, as it's slow; the product is updated when it's done
+        if isinstance(photo_list, list):
+            downloads.downloader.submit(self.__download_product_image, product.id, product.name, photo_file)
         # Notify the user
         self.bot.send_message(self.chat.id, self.loc.get("success_product_edited"))
 
+    def __download_product_image(self, product_id: int, name: str, file: telegram.File):
+        """Download the new image of a product, then pass it to the image pipeline to be stored.
+        This runs in the download pool, while the conversation goes on."""
+        last_progress = 0.0
+
+        def progress(downloaded: int, size: Optional[int]):
+            nonlocal last_progress
+            # A chat action is shown for 5 seconds, so it's sent again a bit earlier
+            if time.monotonic() - last_progress < 4:
+                return
+            last_progress = time.monotonic()
+            log.debug(f"Downloaded {downloaded}/{size or '?'} bytes of the image of the product {product_id}")
+            self.bot.send_chat_action(self.chat.id, action="upload_photo")
+
+        try:
+            path = downloads.downloader.download(file, progress=progress)
+        except Exception as error:
+            log.error(f"Couldn't download the image of the product {product_id}: {error!r}")
+            self.bot.send_message(self.chat.id, self.loc.get("error_image_download", name=escape(name)))
+            return
+        imaging.pipeline.submit(self.__store_product_image, product_id, name, file.file_id, path)
+
+    def __store_product_image(self, product_id: int, name: str, file_id: str, path: str):
+        """Normalise the downloaded image of a product and store it, in a separate session, then notify the user.
+        This runs in the image pipeline, while the conversation goes on."""
+        session = self.sessionmaker()
+        try:
+            with open(path, "rb") as file:
+                image = imaging.pipeline.normalise(file.read())
+            product = session.query(db.Product).filter_by(id=product_id).one()
+            product.store_image(image)
+            # The image was sent to the bot, so it can be sent again through the same file_id
+            product.image_file_id = file_id
+            session.commit()
+            # Show the new image to the customers
+            catalog.invalidate()
+        except Exception:
+            log.exception(f"Couldn't store the image of the product {product_id}")
+            self.bot.send_message(self.chat.id, self.loc.get("error_image_download", name=escape(name)))
+            return
+        finally:
+            session.close()
+            os.unlink(path)
+        self.bot.send_message(self.chat.id, self.loc.get("success_image_stored", name=escape(name)))
+
     def __delete_product_menu(self):
         log.debug("Displaying __delete_product_menu")
         # Get the products list from the db
@@ -1363,7 +1692,7 @@ class Worker(threading.Thread):
         self.bot.send_message(self.chat.id, self.loc.get("conversation_admin_select_product_to_delete"),
                               reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True))
         # Wait for a reply from the user
-        selection = self.__wait_for_specific_message(product_names, cancellable=True)
+        selection = yield from self.__wait_for_specific_message(product_names, cancellable=True)
         if isinstance(selection, CancelSignal):
             # Exit the menu
             return
@@ -1373,6 +1702,8 @@ class Worker(threading.Thread):
             # "Delete" the product by setting the deleted flag to true
             product.deleted = True
             self.session.commit()
+            # Hide the product from the customers
+            catalog.invalidate()
             # Notify the user
             self.bot.send_message(self.chat.id, self.loc.get("success_product_deleted"))
 
@@ -1388,7 +1719,7 @@ class Worker(threading.Thread):
                               self.loc.get("conversation_open_help_menu"),
                               reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True))
         # Wait for a reply from the user
-        selection = self.__wait_for_specific_message([
+        selection = yield from self.__wait_for_specific_message([
             self.loc.get("menu_guide"),
             self.loc.get("menu_contact_shopkeeper")
         ], cancellable=True)
@@ -1410,7 +1741,7 @@ class Worker(threading.Thread):
         """Add an administrator to the bot."""
         log.debug("Displaying __add_admin")
         # Let the admin select an administrator to promote
-        user = self.__user_select()
+        user = yield from self.__user_select()
         # Allow the cancellation of the operation
         if isinstance(user, CancelSignal):
             return
@@ -1424,7 +1755,7 @@ class Worker(threading.Thread):
             self.bot.send_message(self.chat.id, self.loc.get("conversation_confirm_admin_promotion"),
                                   reply_markup=keyboard)
             # Wait for an answer
-            selection = self.__wait_for_specific_message([self.loc.get("emoji_yes"), self.loc.get("emoji_no")])
+            selection = yield from self.__wait_for_specific_message([self.loc.get("emoji_yes"), self.loc.get("emoji_no")])
             # Proceed only if the answer is yes
             if selection == self.loc.get("emoji_no"):
                 return
@@ -1458,7 +1789,7 @@ class Worker(threading.Thread):
                                                chat_id=self.chat.id,
                                                reply_markup=inline_keyboard)
             # Wait for an user answer
-            callback = self.__wait_for_inlinekeyboard_callback()
+            callback = yield from self.__wait_for_inlinekeyboard_callback()
             # Toggle the correct property
             if callback.data == "toggle_edit_products":
                 admin.edit_products = not admin.edit_products
@@ -1487,7 +1818,7 @@ class Worker(threading.Thread):
                               self.loc.get("conversation_language_select"),
                               reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True))
         # Wait for an answer
-        response = self.__wait_for_specific_message(list(options.keys()))
+        response = yield from self.__wait_for_specific_message(list(options.keys()))
         # Set the language to the corresponding value
         self.user.language = options[response]
         # Commit the edit to the database
@@ -1495,6 +1826,60 @@ class Worker(threading.Thread):
         # Recreate the localization object
         self.__create_localization()
 
+    def __get_catalog(self) -> catalog.Catalog:
+        """Get the cached snapshot of the catalog, shared by all the workers of the process."""
+        return catalog.get(self.sessionmaker, max_age=self.cfg["Catalog"]["max_age"])
+
+    def __save_checkpoint(self, step: str, cart):
+        """Save the state of the order being placed, so that it can be resumed if the bot is restarted."""
+        if not self.cfg["Telegram"]["conversation_checkpoints"]:
+            return
+        state = {
+            "step": step,
+            "level": self.__order_level,
+            "cart": [[product_id, item[1], item[2].id if item[2] is not None else None]
+                     for product_id, item in cart.items()],
+        }
+        # Use a separate session, so that committing doesn't expire the objects of the conversation
+        session = self.sessionmaker()
+        try:
+            session.merge(db.Checkpoint(chat_id=self.chat.id,
+                                        state=json.dumps(state, separators=(",", ":")),
+                                        update_date=datetime.datetime.now()))
+            session.commit()
+        finally:
+            session.close()
+
+    def __load_checkpoint(self, state: dict):
+        """Get the category levels and the cart saved in a checkpoint, skipping the products which don't exist
+        anymore."""
+        shop = self.__get_catalog()
+        level = [category_id for category_id in state["level"]
+                 if category_id is None or category_id in shop.categories]
+        cart = {}
+        for product_id, quantity, size_id in state["cart"]:
+            product = shop.products.get(product_id)
+            if product is None:
+                continue
+            size = None
+            if size_id is not None:
+                size = shop.sizes.get(size_id)
+                if size is None:
+                    continue
+            cart[product_id] = [product, quantity, size]
+        return level, cart
+
+    def __delete_checkpoint(self):
+        """Delete the checkpoint of the conversation, if there is one."""
+        if not self.cfg["Telegram"]["conversation_checkpoints"]:
+            return
+        session = self.sessionmaker()
+        try:
+            session.query(db.Checkpoint).filter_by(chat_id=self.chat.id).delete()
+            session.commit()
+        finally:
+            session.close()
+
     def __create_localization(self):
         # Check if the user's language is enabled; if it isn't, change it to the default
         if self.user.language not in self.cfg["Language"]["enabled_languages"]:
@@ -1515,16 +1900,18 @@ class Worker(threading.Thread):
         )
 
     def __graceful_stop(self, stop_trigger: StopSignal):
-        """Handle the graceful stop of the thread."""
+        """Handle the graceful stop of the conversation."""
         log.debug("Gracefully stopping the conversation")
         # If the session has expired...
         if stop_trigger.reason == "timeout":
             # Notify the user that the session has expired and remove the keyboard
             self.bot.send_message(self.chat.id, self.loc.get('conversation_expired'),
                                   reply_markup=telegram.ReplyKeyboardRemove())
+            # The conversation can't be resumed anymore
+            self.__delete_checkpoint()
         # If a restart has been requested...
         # Do nothing.
         # Close the database session
         self.session.close()
-        # End the process
+        # End the conversation; the pool catches the SystemExit
         sys.exit(0)